@@ -0,0 +1,76 @@
+"""Compare escape_tex with the regular expression version it replaced.
+
+Usage::
+
+    python benchmarks/escape_tex.py [--paragraphs N] [--number N]
+
+Escapes a long synthetic entry, and a text of the same length that is
+full of characters that need escaping, with both versions, and prints
+the time of each as JSON.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from dayone_export import filters
+from synthetic import _text
+import random
+
+# The substitutions of escape_tex before it used str.replace.
+REFERENCE_SUBS = (
+    (re.compile(r'\\'), r'\\textbackslashzzz'),
+    (re.compile(r'([{}_#%&$])'), r'\\\1'),
+    (re.compile(r'~'), r'\\textasciitilde{}'),
+    (re.compile(r'\^'), r'\\textasciicircum{}'),
+    (re.compile(r'"'), r"''"),
+    (re.compile(r'\.\.\.+'), r'\\ldots'),
+    (re.compile(r'\\textbackslashzzz'), r'\\textbackslash{}'),
+)
+
+def reference_escape_tex(value):
+    """The old escape_tex, one regular expression at a time."""
+    for pattern, replacement in REFERENCE_SUBS:
+        value = pattern.sub(replacement, value)
+    return value
+
+
+SYMBOLS = (u'Spent $20 on "coffee" & cake at 50% off... then wrote '
+           u'C:\\Users\\me\\notes_{draft}.txt #busy ~tired ^_^ .. ok.\n')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--paragraphs', type=int, default=40,
+                        help='length of the entry (default: %(default)s)')
+    parser.add_argument('--number', type=int, default=1000,
+                        help='number of repetitions (default: %(default)s)')
+    args = parser.parse_args(args)
+
+    entry = _text(random.Random(0), args.paragraphs)
+    symbols = (SYMBOLS * (len(entry) // len(SYMBOLS) + 1))[:len(entry)]
+
+    results = {'length': len(entry)}
+    for text_name, text in [('entry', entry), ('symbols', symbols)]:
+        assert filters.escape_tex(text) == reference_escape_tex(text)
+        times = {}
+        for name, func in [('reference', reference_escape_tex),
+                           ('escape_tex', filters.escape_tex)]:
+            seconds = min(timeit.repeat(lambda: func(text),
+                                        number=args.number, repeat=3))
+            times[name] = round(seconds / args.number, 9)
+        times['speedup'] = round(times['reference'] / times['escape_tex'], 1)
+        results[text_name] = times
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Time each stage of an export of a synthetic journal.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py [--entries N] [--photos N] [--output FILE]
+
+The results are printed (or written to FILE) as JSON, so that they can be
+compared across releases. For each stage, the report contains the wall
+time, the throughput in entries per second and, on Python 3, the peak
+memory allocated during the stage.
+"""
+
+from __future__ import print_function
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import dayone_export as doe
+from dayone_export import filters
+from synthetic import make_journal
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def measure(func, memory=True):
+    """Run func, returning (result, seconds, peak bytes or None).
+
+    If memory is true, func is run a second time with tracemalloc enabled
+    to find the peak memory, so that tracing does not affect the time.
+    """
+    start = time.time()
+    result = func()
+    seconds = time.time() - start
+
+    peak = None
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run(folder, memory=True):
+    """Time each stage of an export of the journal in folder"""
+    stages = []
+
+    def stage(name, count, func):
+        result, seconds, peak = measure(func, memory)
+        stages.append({
+            'stage': name,
+            'items': count,
+            'seconds': round(seconds, 6),
+            'items_per_second': round(count / seconds, 1) if seconds else None,
+            'peak_bytes': peak,
+        })
+        return result
+
+    j = doe.parse_journal(folder)
+    n = len(j)
+
+    stage('parse', n, lambda: doe.parse_journal(folder))
+    stage('localize', n, lambda: doe._localize(j))
+    selected = stage('filter', n, lambda: doe._select_entries(
+        j, tags=['work', 'travel'], exclude=['health'],
+        after=j[n // 2]['Creation Date']))
+
+    md = filters.markdown_filter()
+    stage('markdown', n, lambda: [md(e['Text']) for e in j])
+
+    template = doe._load_template(folder, format='html')
+    today = datetime.today()
+    output = stage('render', n,
+                   lambda: template.render(journal=j, today=today))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        def write():
+            with open(os.path.join(tmp, 'journal.html'), 'wb') as f:
+                f.write(output.encode('utf-8'))
+        stage('write', n, write)
+    finally:
+        shutil.rmtree(tmp)
+
+    with_photos = [e for e in j if 'Photo' in e]
+    if with_photos:
+        stage('imgbase64', len(with_photos), lambda: [
+            filters.imgbase64(e['Photo'], dayone_folder=folder)
+            for e in with_photos])
+
+    return {
+        'python': platform.python_version(),
+        'dayone_export': doe.VERSION,
+        'entries': n,
+        'selected_entries': len(selected),
+        'photos': len(with_photos),
+        'output_bytes': len(output.encode('utf-8')),
+        'max_rss_kb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                       if resource is not None else None),
+        'stages': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--photos', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--journal', metavar='FOLDER',
+                        help='use an existing journal instead')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure peak memory')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write JSON results to this file')
+    args = parser.parse_args()
+
+    tmp = None
+    folder = args.journal
+    if folder is None:
+        tmp = tempfile.mkdtemp()
+        folder = os.path.join(tmp, 'Journal.dayone')
+        make_journal(folder, args.entries, args.photos, args.seed)
+
+    try:
+        results = run(folder, memory=not args.no_memory)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Time how long the command line tool takes to start.
+
+Usage::
+
+    python benchmarks/startup.py [--number N] [--budget MS]
+
+Runs ``dayone_export --version`` and an import of ``dayone_export.cli``
+in fresh interpreters, and prints the median times as JSON, together with
+the slowest imports reported by ``python -X importtime`` (Python 3.7 and
+later). With ``--budget``, exits with an error if importing
+``dayone_export.cli`` takes longer than MS milliseconds.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Modules that are slow to import, and only needed once an export starts.
+HEAVY_MODULES = ['jinja2', 'pytz', 'markdown', 'PIL', 'dateutil',
+                 'multiprocessing']
+
+
+def _python(args, stderr=None):
+    """Run python with args in the source tree, returning its output."""
+    return subprocess.check_output([sys.executable] + args, cwd=ROOT,
+                                   stderr=stderr).decode('utf-8')
+
+
+def loaded_modules(code, modules=HEAVY_MODULES):
+    """Return which of the modules are imported after running code."""
+    script = code + '\nimport sys\nprint(" ".join(m for m in {0!r} ' \
+                    'if m in sys.modules))'.format(list(modules))
+    # the last line, after anything the code printed
+    return _python(['-c', script]).split('\n')[-2].split()
+
+
+def wall_time(args):
+    """Return the seconds taken to run python with args."""
+    start = time.time()
+    _python(args, stderr=subprocess.STDOUT)
+    return time.time() - start
+
+
+def import_times(module):
+    """Return the cumulative import time of each module, in microseconds."""
+    output = _python(['-X', 'importtime', '-c', 'import ' + module],
+                     stderr=subprocess.STDOUT)
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=10,
+                        help="number of runs of each command")
+    parser.add_argument('--budget', type=float, metavar='MS',
+                        help="maximum time to import dayone_export.cli")
+    args = parser.parse_args()
+
+    results = {
+        'python': sys.version.split()[0],
+        'python_seconds': median(
+            wall_time(['-c', 'pass']) for _ in range(args.number)),
+        'version_seconds': median(
+            wall_time(['-m', 'dayone_export.cli', '--version'])
+            for _ in range(args.number)),
+        'heavy_modules_loaded': loaded_modules('import dayone_export.cli'),
+    }
+
+    import_ms = None
+    if sys.version_info >= (3, 7):
+        runs = [import_times('dayone_export.cli') for _ in range(args.number)]
+        import_ms = median(run['dayone_export.cli'] for run in runs) / 1000.0
+        slowest = sorted(runs[-1].items(), key=lambda item: -item[1])[:10]
+        results['import_ms'] = import_ms
+        results['slowest_imports_ms'] = [[name, us / 1000.0]
+                                         for name, us in slowest]
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.budget is not None and import_ms is not None:
+        if import_ms > args.budget:
+            sys.exit("Importing dayone_export.cli took {0:.1f} ms, over the "
+                     "budget of {1} ms".format(import_ms, args.budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Generate synthetic Day One journals for benchmarking.
+
+Usage::
+
+    python benchmarks/synthetic.py [--entries N] [--photos N] FOLDER
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import os
+import plistlib
+import random
+import uuid
+
+WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam quis
+nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis
+aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur
+excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt
+mollit anim id est laborum""".split()
+
+TAGS = ['work', 'family', 'travel', 'food', 'reading', 'running', 'music',
+        'ideas', 'health', 'garden']
+
+TIME_ZONES = ['America/Los_Angeles', 'America/New_York', 'Europe/London',
+              'Europe/Paris', 'Asia/Tokyo']
+
+PLACES = [
+    ('Zoo', 'Seattle', 'Washington', 'United States'),
+    ('Office', 'Santa Barbara', 'CA', 'United States'),
+    ('Cafe', 'Paris', 'Ile-de-France', 'France'),
+    ('Park', 'Tokyo', 'Tokyo', 'Japan'),
+    ('Station', 'London', 'England', 'United Kingdom'),
+]
+
+
+def _write_plist(data, filename):
+    if hasattr(plistlib, 'dump'):
+        with open(filename, 'wb') as f:
+            plistlib.dump(data, f)
+    else:
+        plistlib.writePlist(data, filename)
+
+
+def _text(rng, paragraphs):
+    """Random markdown text"""
+    result = []
+    for _ in range(paragraphs):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 120))]
+        # some emphasis, links and special characters
+        i = rng.randrange(len(words))
+        words[i] = '**' + words[i] + '**'
+        if rng.random() < 0.2:
+            words.append('http://example.com/' + rng.choice(WORDS))
+        if rng.random() < 0.2:
+            words.append('100% & $5 {x_1} #' + rng.choice(WORDS))
+        result.append(' '.join(words) + '.')
+    return '\n\n'.join(result)
+
+
+def _photo(filename, rng):
+    """Write a photo, or return False if PIL is not available"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+    color = tuple(rng.randrange(256) for _ in range(3))
+    Image.new('RGB', (1200, 900), color).save(filename, 'jpeg')
+    return True
+
+
+def make_journal(folder, entries=1000, photos=0, seed=0):
+    """Create a Day One journal with random entries.
+
+    :param folder: Name of the folder to create.
+    :param entries: Number of entries.
+    :param photos: Number of entries that have a photo. Photos are only
+                   created if the Python Imaging Library is available.
+    :param seed: Seed for the random number generator.
+    :returns: The number of photos created.
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(folder, 'entries'))
+    os.makedirs(os.path.join(folder, 'photos'))
+
+    date = datetime(2005, 1, 1)
+    created = 0
+    for i in range(entries):
+        date += timedelta(seconds=rng.randint(3600, 2 * 86400))
+        uid = uuid.UUID(int=rng.getrandbits(128)).hex.upper()
+        place = rng.choice(PLACES)
+        data = {
+            'Creation Date': date,
+            'Entry Text': _text(rng, rng.randint(1, 6)),
+            'Starred': rng.random() < 0.1,
+            'UUID': uid,
+            'Creator': {'Device Agent': 'iPhone/iPhone6,1',
+                        'Generation Date': date,
+                        'Host Name': 'iPhone',
+                        'OS Agent': 'iOS/7.0.3',
+                        'Software Agent': 'Day One iOS/1.12'},
+        }
+        if rng.random() < 0.9:
+            data['Time Zone'] = rng.choice(TIME_ZONES)
+        if rng.random() < 0.5:
+            data['Tags'] = rng.sample(TAGS, rng.randint(1, 3))
+        if rng.random() < 0.7:
+            data['Location'] = {
+                'Place Name': place[0], 'Locality': place[1],
+                'Administrative Area': place[2], 'Country': place[3],
+                'Latitude': rng.uniform(-90, 90),
+                'Longitude': rng.uniform(-180, 180)}
+        if rng.random() < 0.5:
+            data['Weather'] = {'Celsius': '16', 'Fahrenheit': '61',
+                               'Description': 'Mostly Sunny',
+                               'IconName': 'pcloudy.png'}
+        _write_plist(data, os.path.join(folder, 'entries', uid + '.doentry'))
+
+        if created < photos and _photo(
+                os.path.join(folder, 'photos', uid + '.jpg'), rng):
+            created += 1
+
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('folder')
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--photos', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_journal(args.folder, args.entries, args.photos, args.seed)
+
+
+if __name__ == '__main__':
+    main()
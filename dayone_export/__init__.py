@@ -6,25 +6,139 @@
 
 """Export Day One journal entries using a Jinja template."""
 
+# jinja2, pytz and multiprocessing are slow to import, so they are imported
+# when they are first needed, to keep the command line tool quick to start
+
 from operator import itemgetter
 from functools import partial
 from . import compat
 from . import filters
+from .cache import EntryCache, OutputCache, ThumbnailCache, MarkdownCache
+from .cache import THUMBNAIL_CACHE_SIZE, cache_path, entries_digest
+from .stats import Stats, NO_STATS
 from .version import VERSION
-import jinja2
 import plistlib
 import os
-import pytz
-from collections import defaultdict
+import re
+from xml.etree import ElementTree
+from collections import OrderedDict
+from bisect import bisect_left
 from datetime import datetime
+from itertools import chain, groupby, islice
 
 class PlistError(Exception):
     pass
 
+
+def _read_plist(filename):
+    """Read the plist data of an entry file.
+
+    :raises: PlistError
+    """
+    try:
+        return plistlib.readPlist(filename)
+    except AttributeError as err:  # See #25.
+        if str(err) == "'NoneType' object has no attribute 'groupdict'":
+            raise PlistError(
+                'Unable to parse {} due to invalid ISO 8601 date.'
+                .format(filename))
+        raise
+    except IOError as err:
+        raise PlistError('Unable to read {}: {}'.format(filename, repr(err)))
+
+
+# Fields read by lazy entries before the rest of the entry file
+HEADER_KEYS = frozenset(['Creation Date', 'UUID', 'Tags', 'Time Zone',
+                         'Starred'])
+
+# Same as plistlib
+_PLIST_DATE = re.compile(
+    r"(?P<year>\d\d\d\d)(?:-(?P<month>\d\d)(?:-(?P<day>\d\d)"
+    r"(?:T(?P<hour>\d\d)(?::(?P<minute>\d\d)(?::(?P<second>\d\d))?)?)?)?)?Z")
+
+
+def _plist_value(filename, elem):
+    """Convert a simple XML plist element to a Python value"""
+    tag = elem.tag
+    if tag == 'string':
+        return elem.text or ''
+    if tag == 'date':
+        match = _PLIST_DATE.match(elem.text or '')
+        if match is None:
+            raise PlistError(
+                'Unable to parse {} due to invalid ISO 8601 date.'
+                .format(filename))
+        return datetime(*[int(v) for v in match.groups() if v is not None])
+    if tag == 'integer':
+        return int(elem.text)
+    if tag == 'real':
+        return float(elem.text)
+    if tag in ('true', 'false'):
+        return tag == 'true'
+    if tag == 'array':
+        return [_plist_value(filename, child) for child in elem]
+    if tag == 'dict':
+        children = list(elem)
+        return dict((k.text, _plist_value(filename, v))
+                    for k, v in zip(children[::2], children[1::2]))
+    raise ValueError(tag)
+
+
+def _read_plist_header(filename):
+    """Read the header fields from an XML entry file.
+
+    Other fields are skipped without being converted. Returns None if the
+    file is not an XML plist.
+
+    :raises: PlistError
+    """
+    header = {}
+    key = None
+    depth = 0
+    try:
+        for event, elem in ElementTree.iterparse(filename, ('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            # <plist><dict><key/><value/>...
+            if depth != 2:
+                continue
+            if elem.tag == 'key':
+                key = elem.text
+            elif key in HEADER_KEYS:
+                header[key] = _plist_value(filename, elem)
+            elem.clear()
+    except ElementTree.ParseError:
+        return None
+    except ValueError:
+        return None
+    except IOError as err:
+        raise PlistError('Unable to read {}: {}'.format(filename, repr(err)))
+    return header
+
+
+def _interned(data):
+    """Return a copy of a dictionary with interned keys.
+
+    Every entry has the same few dozen keys, so this saves a copy of each
+    key for each entry.
+    """
+    return dict((compat.intern(k) if type(k) is str else k, v)
+                for k, v in data.items())
+
+
 class Entry(object):
     """Parse a single journal entry.
 
-    :raises: IOError, KeyError
+    :param filename: Path to the entry file.
+    :param data: The already parsed plist data of the file. If given,
+                 the file is not read.
+    :param lazy: Only read the header fields (see ``HEADER_KEYS``), which
+                 are enough to sort and filter entries. The rest of the file
+                 is read when another field is first used. If *data* is
+                 given, it only needs to contain the header fields.
+    :raises: PlistError, KeyError
 
     Acts like a read-only dictionary.
     The keys are as defined in the plist file by the Day One App, with
@@ -33,7 +147,7 @@ class Entry(object):
     - What Day One calls "Entry Text", we call "Text".
     - The "Location", "Weather", "Creator", and "Music" dictionaries are
       flattened, so that their subkeys are accessible as keys of the main
-      dictionary.
+      dictionary. (They are looked up in that order, and are not copied.)
     - The "Photo" key is added and contains the path to attached photo.
     - The "Date" key is added and contains the localized date.
 
@@ -41,47 +155,83 @@ class Entry(object):
     attached time zone) corresponding to the UTC time.
     """
 
-    def __init__(self, filename):
-        try:
-            self.data = plistlib.readPlist(filename)
-        except AttributeError as err:  # See #25.
-            if str(err) == "'NoneType' object has no attribute 'groupdict'":
-                raise PlistError(
-                    'Unable to parse {} due to invalid ISO 8601 date.'
-                    .format(filename))
-            raise
-        except IOError as err:
-            raise PlistError('Unable to read {}: {}'.format(filename, repr(err)))
+    # keep entries small, since a journal can have very many of them
+    __slots__ = ('filename', '_loaded', '_data')
+
+    # dictionaries whose keys are also keys of the entry, in order of priority
+    NESTED_KEYS = ('Location', 'Weather', 'Music', 'Creator')
+
+    def __init__(self, filename, data=None, lazy=False):
+        self.filename = filename
+        self._loaded = not lazy
+        if data is None:
+            data = _read_plist_header(filename) if lazy else _read_plist(filename)
+        if data is None:
+            # not an XML plist, so read it all
+            data = _read_plist(filename)
+            self._loaded = True
 
         # Required fields
-        if "Creation Date" not in self.data:
+        if "Creation Date" not in data:
             raise KeyError("Creation Date")
 
-        # aliases and flattening
-        self.data['Text'] = self.data.pop('Entry Text', "")
-        for key in ['Location', 'Weather', 'Music', 'Creator']:
-            if key in self.data:
-                new_keys = ((k, v) for k, v in self.data[key].items()
-                            if k not in self.data) # prevent overwrite
-                self.data.update(new_keys)
+        self._data = self._prepare(data) if self._loaded else dict(data)
+
+    @classmethod
+    def _prepare(cls, data):
+        """Return a copy of the plist data with aliases and interned keys"""
+        data = _interned(data)
+        data['Text'] = data.pop('Entry Text', "")
+        for key in cls.NESTED_KEYS:
+            if key in data:
+                data[key] = _interned(data[key])
+        return data
+
+    def _load(self):
+        """Return the (unflattened) data, reading the file if necessary"""
+        if not self._loaded:
+            data = self._prepare(_read_plist(self.filename))
+            # keep header fields and anything that has been set
+            data.update(self._data)
+            self._data = data
+            self._loaded = True
+        return self._data
+
+    @property
+    def data(self):
+        """The entry's data, as a (newly made, flattened) dictionary"""
+        data = dict(self._load())
+        for key in self.NESTED_KEYS:
+            if key in data:
+                new_keys = ((k, v) for k, v in data[key].items()
+                            if k not in data) # prevent overwrite
+                data.update(new_keys)
+        return data
+
+    def __getstate__(self):
+        return self.filename, self._loaded, self._data
+
+    def __setstate__(self, state):
+        self.filename, self._loaded, self._data = state
 
     def set_photo(self, filename):
         """Set the filename of the photo"""
-        self.data['Photo'] = filename
+        self._data['Photo'] = filename
 
     def set_localized_date(self, timezone):
-        """Set the localized date (the "Date" key)"""
-        try:
-            tz = pytz.timezone(timezone)
-        except pytz.UnknownTimeZoneError:
-            tz = pytz.utc
+        """Set the localized date (the "Date" key)
 
-        localized_utc = pytz.utc.localize(self["Creation Date"])
-        self.data["Date"] = localized_utc.astimezone(tz)
+        :param timezone: The name of a time zone (UTC if it is unknown),
+                         or a pytz time zone.
+        """
+        if isinstance(timezone, compat.string_types):
+            timezone = filters.timezone(timezone)
+        utc = self["Creation Date"].replace(tzinfo=timezone)
+        self._data["Date"] = timezone.fromutc(utc)
 
     def set_time_zone(self, timezone):
         """Set the time zone"""
-        self.data["Time Zone"] = timezone
+        self._data["Time Zone"] = timezone
 
     def place(self, levels=4, ignore=None):
         """Format entry's location as string, with places separated by commas.
@@ -142,18 +292,35 @@ class Entry(object):
             return "" # fail silently
 
         if temperature_type.lower() == 'celsius' or temperature_type.lower() == 'c':
-            temperature = self.data['Celsius']
+            temperature = self['Celsius']
         else:
-            temperature = self.data['Fahrenheit']
+            temperature = self['Fahrenheit']
 
-        weather = "{0}&deg; {1}".format(temperature, self.data['Description'])
+        weather = "{0}&deg; {1}".format(temperature, self['Description'])
         return weather
 
     def __getitem__(self, key):
-        return self.data[key]
+        # header fields of a lazy entry do not require reading the file
+        data = self._data
+        if key in data:
+            return data[key]
+        if not self._loaded:
+            if key in HEADER_KEYS:
+                raise KeyError(key)
+            data = self._load()
+            if key in data:
+                return data[key]
+        for nested in self.NESTED_KEYS:
+            if nested in data and key in data[nested]:
+                return data[nested][key]
+        raise KeyError(key)
 
     def __contains__(self, key):
-        return key in self.data
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
 
     def keys(self):
         """List all keys."""
@@ -163,18 +330,374 @@ class Entry(object):
         return "<Entry at {0}>".format(self['Creation Date'])
 
 
-def parse_journal(foldername):
-    """Return a list of Entry objects, sorted by date"""
+def _clears_indexes(name):
+    """Return the list method name, changed to also clear the indexes."""
+    method = getattr(list, name)
 
-    journal = dict()
-    for filename in os.listdir(os.path.join(foldername, 'entries')):
-        if os.path.splitext(filename)[1] == '.doentry':
-            try:
-                entry = Entry(os.path.join(foldername, 'entries', filename))
-            except KeyError as err:
-                pass
+    def mutate(self, *args, **kwargs):
+        self._clear_indexes()
+        return method(self, *args, **kwargs)
+
+    mutate.__name__ = name
+    mutate.__doc__ = method.__doc__
+    return mutate
+
+class Journal(list):
+    """A list of entries, sorted by date, with indexes for fast filtering.
+
+    Acts like a list, and should not be modified. Indexes are built the
+    first time they are needed, so a journal can be queried many times
+    without looking at every entry each time.
 
-            journal[entry['UUID']] = entry
+    Date queries use binary search, so they take time proportional to
+    the logarithm of the size of the journal. If the entries are not
+    sorted by date (for example, in a reversed journal), they fall back
+    to checking every entry.
+
+    Locations are not header fields, so the place index reads the whole
+    entry file of lazy entries.
+
+    The indexes are discarded whenever the list is changed.
+    """
+
+    # levels of Location that are indexed by place
+    PLACE_KEYS = ('Place Name', 'Locality', 'Administrative Area', 'Country')
+
+    def __init__(self, entries=()):
+        list.__init__(self, entries)
+        self._clear_indexes()
+
+    def _clear_indexes(self):
+        self._tag_index = None
+        self._tagged = None
+        self._dates = None
+        self._starred = None
+        self._place_index = None
+        self._uuid_index = None
+
+    append = _clears_indexes('append')
+    extend = _clears_indexes('extend')
+    insert = _clears_indexes('insert')
+    pop = _clears_indexes('pop')
+    remove = _clears_indexes('remove')
+    reverse = _clears_indexes('reverse')
+    sort = _clears_indexes('sort')
+    __setitem__ = _clears_indexes('__setitem__')
+    __delitem__ = _clears_indexes('__delitem__')
+    __iadd__ = _clears_indexes('__iadd__')
+    __imul__ = _clears_indexes('__imul__')
+    if hasattr(list, 'clear'):
+        clear = _clears_indexes('clear')
+    if compat.PY2:
+        __setslice__ = _clears_indexes('__setslice__')
+        __delslice__ = _clears_indexes('__delslice__')
+
+    def _date_index(self):
+        """Return the list of creation dates, or False if not sorted."""
+        if self._dates is None:
+            dates = [entry['Creation Date'] for entry in self]
+            if any(dates[i] > dates[i + 1] for i in range(len(dates) - 1)):
+                dates = False
+            self._dates = dates
+        return self._dates
+
+    def date_span(self, after=None, before=None):
+        """Return (start, stop) such that ``journal[start:stop]`` are the
+        entries created at or after *after* and before *before*.
+
+        Dates are naive datetimes representing UTC times, and either can
+        be None. The journal must be sorted by date.
+        """
+        dates = self._date_index()
+        if dates is False:
+            raise ValueError('journal is not sorted by date')
+        start = 0 if after is None else bisect_left(dates, after)
+        stop = len(dates) if before is None else bisect_left(dates, before)
+        return start, max(start, stop)
+
+    def between(self, after=None, before=None):
+        """Return a Journal of the entries created at or after *after* and
+        before *before*.
+
+        Dates are naive datetimes representing UTC times, and either can
+        be None.
+        """
+        if self._date_index() is False:
+            return self.query(after=after, before=before)
+        start, stop = self.date_span(after, before)
+        return Journal(self[start:stop])
+
+    def _scan_dates(self, positions, after, before):
+        return [i for i in positions
+                if (after is None or self[i]['Creation Date'] >= after) and
+                   (before is None or self[i]['Creation Date'] < before)]
+
+    def _build_tag_index(self):
+        index = dict()
+        tagged = []
+        for position, entry in enumerate(self):
+            if 'Tags' in entry:
+                tagged.append(position)
+                for tag in set(entry['Tags']):
+                    index.setdefault(tag, []).append(position)
+        self._tag_index = index
+        self._tagged = tagged
+
+    @property
+    def tag_index(self):
+        """Dictionary mapping each tag to the sorted positions of its entries.
+
+        In a template, this can be used to make a tag cloud.
+        """
+        if self._tag_index is None:
+            self._build_tag_index()
+        return self._tag_index
+
+    def tag_counts(self):
+        """Dictionary mapping each tag to its number of entries."""
+        return dict((tag, len(positions))
+                    for tag, positions in self.tag_index.items())
+
+    def tagged(self, tags):
+        """Return the sorted positions of the entries with any of the tags.
+
+        If *tags* is the string ``any``, return the positions of the entries
+        that have tags.
+        """
+        if tags == 'any':
+            if self._tagged is None:
+                self._build_tag_index()
+            return list(self._tagged)
+        index = self.tag_index
+        postings = [index[tag] for tag in set(tags) if tag in index]
+        if len(postings) == 1:
+            return list(postings[0])
+        return sorted(set().union(*postings))
+
+    def starred(self):
+        """Return the sorted positions of the starred entries."""
+        if self._starred is None:
+            self._starred = [position for position, entry in enumerate(self)
+                             if 'Starred' in entry and entry['Starred']]
+        return list(self._starred)
+
+    @property
+    def place_index(self):
+        """Dictionary mapping each place name, city, state and country to
+        the sorted positions of its entries."""
+        if self._place_index is None:
+            index = dict()
+            for position, entry in enumerate(self):
+                if 'Location' not in entry:
+                    continue
+                location = entry['Location']
+                names = set(location[key] for key in self.PLACE_KEYS
+                            if location.get(key))
+                for name in names:
+                    index.setdefault(name, []).append(position)
+            self._place_index = index
+        return self._place_index
+
+    def by_uuid(self, uuid):
+        """Return the entry with the given UUID.
+
+        Raises KeyError if there is no such entry.
+        """
+        if self._uuid_index is None:
+            self._uuid_index = dict((entry['UUID'], position)
+                                    for position, entry in enumerate(self)
+                                    if 'UUID' in entry)
+        return self[self._uuid_index[uuid]]
+
+    def positions(self, tags=None, exclude=None, after=None, before=None,
+                  starred=None, place=None):
+        """Return the sorted positions of entries matching all the criteria.
+
+        :param tags: Only entries with any of these tags, or with any tag
+                     if this is the string ``any``.
+        :param exclude: Only entries with none of these tags.
+        :param after: Only entries created at or after this naive UTC date.
+        :param before: Only entries created before this naive UTC date.
+        :param starred: If true, only starred entries; if false (but not
+                        None), only entries that are not starred.
+        :param place: Only entries whose place name, city, state or country
+                      is this string.
+        """
+        start, stop = 0, len(self)
+        required = []
+        if after is not None or before is not None:
+            if self._date_index() is False:
+                required.append(self._scan_dates(range(len(self)),
+                                                 after, before))
+            else:
+                start, stop = self.date_span(after, before)
+        if tags is not None:
+            required.append(self.tagged(tags))
+        if starred:
+            required.append(self.starred())
+        if place is not None:
+            required.append(self.place_index.get(place, []))
+
+        # each list of positions is sorted, so the range can be bisected
+        required = [p[bisect_left(p, start):bisect_left(p, stop)]
+                    for p in required]
+        if not required:
+            positions = range(start, stop)
+        else:
+            # intersect, starting from the shortest list
+            required.sort(key=len)
+            positions = required[0]
+            for other in required[1:]:
+                other = set(other)
+                positions = [i for i in positions if i in other]
+
+        excluded = set()
+        if exclude is not None:
+            excluded.update(self.tagged(exclude))
+        if starred is not None and not starred:
+            excluded.update(self.starred())
+        if excluded:
+            positions = [i for i in positions if i not in excluded]
+        return list(positions)
+
+    def query(self, **criteria):
+        """Return a Journal of the entries matching all the criteria.
+
+        Takes the same keyword arguments as :meth:`positions`. For example,
+        ``journal.query(after=datetime(2013, 1, 1), tags=['travel'],
+        starred=True)``.
+        """
+        return Journal(self[i] for i in self.positions(**criteria))
+
+
+def _read_entry_data(filename):
+    """Read the plist data of an entry file for parse_journal.
+
+    A PlistError is returned rather than raised, so that it can be reported
+    in file order even when entries are read by a pool of worker processes.
+    """
+    try:
+        return _read_plist(filename)
+    except PlistError as err:
+        return err
+
+
+def _read_entry_header(filename):
+    """Like _read_entry_data, but only read the header fields."""
+    try:
+        return _read_plist_header(filename)
+    except PlistError as err:
+        return err
+
+
+def _pool_map(func, items, workers=None):
+    """Like map, but use a pool of worker processes if workers > 1.
+
+    Results are returned in the same order as items.
+    """
+    items = list(items)
+    if workers is None or workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    import multiprocessing
+    chunksize = max(1, len(items) // (workers * 4))
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _pool_imap(func, items, workers):
+    """Like _pool_map, but yield each result as soon as it is ready.
+
+    Results are yielded in the same order as items. Each item is sent to
+    a worker process by itself.
+    """
+    if workers is None or workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(func, items):
+            yield result
+    except BaseException:
+        # includes the consumer stopping early
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def parse_journal(foldername, workers=None, cache=None, lazy=False,
+                  stats=None):
+    """Return a :class:`Journal` of Entry objects, sorted by date
+
+    :param workers: Number of worker processes used to parse the entry
+                    files. By default, entries are parsed serially.
+    :type workers: int
+    :param cache: If given, only entry files that are not in the cache
+                  (or have changed) are parsed, and the cache is updated.
+    :type cache: :class:`dayone_export.cache.EntryCache`
+    :param lazy: Only read the header fields of the entries that are not
+                 in the cache; see :class:`Entry`. These entries are not
+                 added to the cache.
+    :type lazy: bool
+    :param stats: If given, the time spent parsing the entries and
+                  localizing their dates is added to it.
+    :type stats: :class:`dayone_export.stats.Stats`
+    """
+    if stats is None:
+        stats = NO_STATS
+    with stats.timer('parse'):
+        journal = _parse_entries(foldername, workers, cache, lazy)
+    with stats.timer('localize'):
+        _localize(journal)
+    return journal
+
+
+def _parse_entries(foldername, workers, cache, lazy):
+    """Return a list of Entry objects without localized dates, sorted by date"""
+
+    entries_folder = os.path.join(foldername, 'entries')
+    filenames = [os.path.join(entries_folder, filename)
+                 for filename in os.listdir(entries_folder)
+                 if os.path.splitext(filename)[1] == '.doentry']
+
+    data = dict()
+    if cache is not None:
+        for filename in filenames:
+            cached = cache.get(filename)
+            if cached is not None:
+                data[filename] = cached
+
+    missing = [filename for filename in filenames if filename not in data]
+    read = _read_entry_header if lazy else _read_entry_data
+    for filename, result in zip(missing, _pool_map(read, missing, workers)):
+        if isinstance(result, PlistError):
+            raise result
+        data[filename] = result
+        if cache is not None and not lazy:
+            cache.put(filename, result)
+
+    if cache is not None:
+        cache.save()
+
+    missing = set(missing)
+    journal = dict()
+    for filename in filenames:
+        try:
+            entry = Entry(filename, data[filename],
+                          lazy=lazy and filename in missing)
+        except KeyError:
+            continue
+        journal[entry['UUID']] = entry
 
     if len(journal) == 0:
         raise Exception("No journal entries found in " + foldername)
@@ -195,8 +718,15 @@ def parse_journal(foldername):
     # make it a list and sort
     journal = list(journal.values())
     journal.sort(key=itemgetter('Creation Date'))
+    return Journal(journal)
 
-    # add timezone info
+
+def _localize(journal):
+    """Set the time zone and localized date of a sorted list of entries.
+
+    Entries without a time zone get the time zone of the closest later
+    entry that has one, or else of the newest entry with a time zone.
+    """
     newest_tz = 'utc'
     for entry in reversed(journal):
         if "Time Zone" in entry:
@@ -204,19 +734,24 @@ def parse_journal(foldername):
             break
 
     tz = newest_tz
+    zones = dict()
     for entry in reversed(journal):
         if "Time Zone" in entry:
             tz = entry["Time Zone"]
         else:
             entry.set_time_zone(tz)
+        zones.setdefault(tz, []).append(entry)
 
-        entry.set_localized_date(tz)
-
-    return journal
+    # look up each time zone once
+    for name, entries in zones.items():
+        tz = filters.timezone(name)
+        for entry in entries:
+            entry.set_localized_date(tz)
 
 
 def _determine_inheritance(template, template_dir, format):
     """Determines where to look for template based on user options"""
+    import jinja2
 
     # explicit path to template => only load that template
     if template is not None:
@@ -248,8 +783,129 @@ def _determine_inheritance(template, template_dir, format):
 
     return loader, template
 
+def _loader_key(template, template_dir):
+    """Identify the loader that _determine_inheritance makes for the options.
+
+    Relative paths depend on the current directory, so they are made
+    absolute.
+    """
+    if template is not None and os.path.dirname(template):
+        return 'path', os.path.abspath(os.path.dirname(template))
+    if template_dir is not None:
+        return 'dir', os.path.abspath(template_dir)
+    cwd = os.getcwd() if template is not None else None
+    return 'default', cwd, os.path.expanduser('~/.dayone_export')
+
+def _template_signature(template):
+    """Identify a template and the version of its source file"""
+    try:
+        mtime = os.path.getmtime(template.filename)
+    except (OSError, TypeError):
+        mtime = None
+    return template.name, template.filename, mtime
+
+def _uses_filter(env, template_name, name):
+    """Whether a template uses the named filter.
+
+    Templates that are included or extended are not examined.
+    """
+    import jinja2
+    source = env.loader.get_source(env, template_name)[0]
+    return any(node.name == name
+               for node in env.parse(source).find_all(jinja2.nodes.Filter))
+
+def _imgbase64_sizes(env, template_name):
+    """Return the max_size arguments of the imgbase64 filters in a template.
+
+    Only arguments that are constants are found, and templates that are
+    included or extended are not examined.
+    """
+    import jinja2
+    source = env.loader.get_source(env, template_name)[0]
+    sizes = set()
+    for node in env.parse(source).find_all(jinja2.nodes.Filter):
+        if node.name != 'imgbase64':
+            continue
+        args = list(node.args)
+        args.extend(kw.value for kw in node.kwargs if kw.key == 'max_size')
+        if not args:
+            sizes.add(filters.DEFAULT_MAX_SIZE)
+        elif isinstance(args[0], jinja2.nodes.Const):
+            sizes.add(args[0].value)
+    return sizes
+
+def _photo_keys(journal, dayone_folder, sizes, cache):
+    """Yield the cache key, path and size of each photo to encode."""
+    for entry in journal:
+        if 'Photo' not in entry:
+            continue
+        path = dayone_folder + "/" + entry['Photo']
+        for size in sizes:
+            try:
+                key = cache.key(path, size, filters.image_format())
+            except OSError:
+                continue
+            yield key, path, size
+
+def _encode_photos(journal, dayone_folder, sizes, cache, workers):
+    """Encode the photos of the entries for the imgbase64 filter.
+
+    The photos are resized and encoded by a pool of worker processes,
+    and the results are stored in the cache, where the filter finds them.
+    Encoding stops once the cache is full, since photos encoded after that
+    would push out the earlier ones before they are used. The filter
+    encodes the rest as it reaches them.
+    """
+    keys, jobs, seen = [], [], set()
+    for key, path, size in _photo_keys(journal, dayone_folder, sizes, cache):
+        if key not in seen and not cache.has(key):
+            seen.add(key)
+            keys.append(key)
+            jobs.append((path, size))
+
+    total = 0
+    results = _pool_imap(filters.encode_image_job, jobs, workers)
+    try:
+        for key, uri in zip(keys, results):
+            if uri is None:
+                continue
+            total += len(uri)
+            if total > cache.max_bytes:
+                break
+            cache.put(key, uri)
+    finally:
+        results.close()
+
+def _markdown_keys(journal, autobold, nl2br, cache):
+    """Yield the cache key and text of each entry without footnotes."""
+    options = filters.markdown_options(autobold, nl2br)
+    for entry in journal:
+        text = entry['Text']
+        if '[^' not in text:
+            yield cache.key(text, options), text
+
+def _convert_markdown(journal, autobold, nl2br, cache, workers):
+    """Convert the text of the entries for the markdown filter.
+
+    The text is converted by a pool of worker processes, and the results
+    are stored in the cache, where the filter finds them. Text with
+    footnotes is left to the filter, since its ids depend on the order
+    of conversion.
+    """
+    keys, jobs, seen = [], [], set()
+    for key, text in _markdown_keys(journal, autobold, nl2br, cache):
+        if key not in seen and cache.get(key) is None:
+            seen.add(key)
+            keys.append(key)
+            jobs.append((autobold, nl2br, text))
+
+    for key, html in zip(keys, _pool_map(filters.markdown_job, jobs, workers)):
+        cache.put(key, html)
+
 def _filter_by_tag(journal, tags):
     """filter by list of tags. tags='any' allows any entry with some tag"""
+    if isinstance(journal, Journal):
+        return [journal[i] for i in journal.tagged(tags)]
     if tags == 'any':
         tag_filter = lambda item: 'Tags' in item
     else:
@@ -259,6 +915,9 @@ def _filter_by_tag(journal, tags):
 
 def _exclude_tags(journal, tags):
     """remain only entries without specified tags"""
+    if isinstance(journal, Journal):
+        excluded = set(journal.tagged(tags))
+        return [e for i, e in enumerate(journal) if i not in excluded]
 
     remain_filter = lambda item: 'Tags' not in item or not set(item['Tags']).intersection(set(tags))
 
@@ -272,24 +931,253 @@ def _filter_by_date(journal, after, before):
     """
     if after is None and before is None:
         return journal
+    if isinstance(journal, Journal):
+        return journal.between(after, before)
     return [item for item in journal
             if (after is None or item['Creation Date'] >= after) and
                (before is None or item['Creation Date'] < before)]
 
+def _group_entries(journal, filename_template):
+    """Split entries into groups with the same formatted filename.
+
+    Yields (filename, Journal) pairs in order of first appearance. When
+    entries with the same filename are adjacent, which is the case for
+    filenames like ``%Y-%m``, each group is yielded as soon as it is
+    complete. Otherwise (e.g. ``%a``), all groups are collected first.
+    """
+    keys = [e['Date'].strftime(filename_template) for e in journal]
+    runs = [k for k, _ in groupby(keys)]
+    pairs = zip(keys, journal)
+
+    if len(runs) == len(set(runs)):
+        for k, group in groupby(pairs, itemgetter(0)):
+            yield k, Journal(e for _, e in group)
+    else:
+        groups = OrderedDict()
+        for k, e in pairs:
+            groups.setdefault(k, []).append(e)
+        for k in groups:
+            yield k, Journal(groups[k])
+
 def _convert_to_utc(date, default_tz):
     """Convert date to UTC, using default_tz if no time zone is set."""
     if date is None:
         return date
     if date.tzinfo is None:
         date = default_tz.localize(date)
+    import pytz
     date.astimezone(pytz.utc)
     # strip timezone info
     return date.replace(tzinfo=None)
 
 
+class _BytecodeCache(object):
+    """Compiled templates, kept in memory and optionally in a directory.
+
+    Stored code is only reused if the template's source is unchanged.
+    The directory is a jinja2.FileSystemBytecodeCache, but errors while
+    storing a template in it are ignored, since the cache is only a speedup.
+    """
+
+    def __init__(self, directory=None):
+        import jinja2
+        self.memory = {}
+        self.disk = None
+        if directory is not None:
+            self.disk = jinja2.FileSystemBytecodeCache(directory)
+        self.keys = self.disk or jinja2.BytecodeCache()
+
+    def get_bucket(self, environment, name, filename, source):
+        from jinja2.bccache import Bucket
+        key = self.keys.get_cache_key(name, filename)
+        checksum = self.keys.get_source_checksum(source)
+        bucket = Bucket(environment, key, checksum)
+        bucket.code = self.memory.get((key, checksum))
+        if bucket.code is None and self.disk is not None:
+            self.disk.load_bytecode(bucket)
+            if bucket.code is not None:
+                self.memory[(key, checksum)] = bucket.code
+        return bucket
+
+    def set_bucket(self, bucket):
+        self.memory[(bucket.key, bucket.checksum)] = bucket.code
+        if self.disk is not None:
+            try:
+                self.disk.dump_bytecode(bucket)
+            except (IOError, OSError):
+                pass
+
+# Compiled templates of this process, by loader, syntax and bytecode
+# directory. Each export has its own Jinja environment, since the filters
+# depend on its options, but a template is only compiled once.
+_bytecode_caches = {}
+
+def _load_template(dayone_folder, template=None, template_dir=None,
+                   format=None, autobold=False, nl2br=False,
+                   markdown_cache=None, thumbnails=None, stats=NO_STATS,
+                   cache_dir=None):
+    """Set up a Jinja environment with our filters and load the template
+
+    If *cache_dir* is given, compiled templates are also stored there
+    for later runs.
+    """
+    import jinja2
+
+    # figure out which template to use
+    key = _loader_key(template, template_dir)
+    loader, template = _determine_inheritance(template, template_dir, format)
+
+    # custom latex template syntax
+    custom_syntax = {}
+    if os.path.splitext(template)[1] == ".tex":
+        custom_syntax = {'block_start_string': r'\CMD{',
+                         'block_end_string': '}',
+                         'variable_start_string': r'\VAR{',
+                         'variable_end_string': '}',
+                         }
+
+    bytecode_dir = None
+    if cache_dir is not None:
+        bytecode_dir = os.path.join(cache_dir, 'templates')
+        try:
+            os.makedirs(bytecode_dir)
+        except OSError:
+            if not os.path.isdir(bytecode_dir):
+                bytecode_dir = None
+
+    # define jinja environment
+    key = key, tuple(sorted(custom_syntax.items())), bytecode_dir
+    try:
+        bytecode_cache = _bytecode_caches[key]
+    except KeyError:
+        bytecode_cache = _bytecode_caches[key] = _BytecodeCache(bytecode_dir)
+    env = jinja2.Environment(loader=loader, trim_blocks=True,
+                             bytecode_cache=bytecode_cache, **custom_syntax)
+
+    # filters
+    env.filters['markdown'] = filters.markdown_filter(autobold=autobold,
+      nl2br=nl2br, cache=markdown_cache)
+    env.filters['format'] = filters.format
+    env.filters['escape_tex'] = filters.escape_tex
+    env.filters['imgbase64'] = partial(filters.imgbase64,
+      dayone_folder=dayone_folder, cache=thumbnails)
+    for name in ['markdown', 'format', 'escape_tex', 'imgbase64']:
+        env.filters[name] = stats.wrap(name, env.filters[name])
+
+    # load template
+    return env.get_template(template)
+
+def _select_entries(journal, tags=None, exclude=None, before=None,
+                    after=None, reverse=False, stats=NO_STATS):
+    """Filter and order the entries of a journal as requested"""
+    default_tz = journal[-1]["Date"].tzinfo
+    after = _convert_to_utc(after, default_tz)
+    before = _convert_to_utc(before, default_tz)
+    j = journal
+    if isinstance(j, Journal):
+        # use the indexes of the whole journal
+        with stats.timer('filter'):
+            j = [j[i] for i in j.positions(tags=tags, exclude=exclude,
+                                           after=after, before=before)]
+    else:
+        with stats.timer('filter by date'):
+            j = _filter_by_date(j, after=after, before=before)
+        if tags is not None:
+            with stats.timer('filter by tag'):
+                j = list(_filter_by_tag(j, tags))
+        if exclude is not None:
+            with stats.timer('exclude tags'):
+                j = list(_exclude_tags(j, exclude))
+        j = list(j)
+    if reverse:
+        j.reverse()
+    return j
+
+def _changed_groups(groups, output_cache, context, dayone_folder=None):
+    """Keep only the (filename, digest, entries) groups that have changed.
+
+    The digest of each group, which includes its photos in dayone_folder,
+    is computed and filled in.
+    """
+    for k, _, group in groups:
+        digest = entries_digest(group, context, dayone_folder)
+        if not output_cache.unchanged(k, digest):
+            yield k, digest, group
+
+def _render_groups(template, groups, today, stream=False, stats=NO_STATS):
+    """Render (filename, digest, entries) groups.
+
+    Yields (filename, digest, output) for each group.
+    """
+    for k, digest, group in groups:
+        if stream:
+            yield k, digest, stats.iterate(
+                    'render', template.generate(journal=group, today=today))
+        else:
+            with stats.timer('render'):
+                output = template.render(journal=group, today=today)
+            yield k, digest, output
+
+def _precomputed(groups, markdown, sizes, dayone_folder, autobold, nl2br,
+                 markdown_cache, thumbnails):
+    """Return the converted markdown and encoded photos of some groups.
+
+    They are returned as two dictionaries from cache keys to values, with
+    the values that are in the caches, so that a worker process rendering
+    the groups need not compute them again. Photos are only included if
+    the thumbnail cache is kept in memory; otherwise the worker reads them
+    from the cache's directory itself.
+    """
+    html, uris = {}, {}
+    for _, _, group in groups:
+        if markdown:
+            for key, _ in _markdown_keys(group, autobold, nl2br,
+                                         markdown_cache):
+                value = markdown_cache.get(key)
+                if value is not None:
+                    html[key] = value
+        if thumbnails.cache_dir is not None:
+            continue
+        for key, _, _ in _photo_keys(group, dayone_folder, sizes, thumbnails):
+            value = thumbnails.memory.get(key)
+            if value is not None:
+                uris[key] = value
+    return html, uris
+
+# Templates loaded by a worker process, with their markdown and thumbnail
+# caches, by options
+_worker_templates = {}
+
+def _render_job(job):
+    """Render groups of entries in a worker process"""
+    options, groups, today, (html, uris) = job
+    key = tuple(sorted(options.items()))
+    try:
+        template, markdown_cache, thumbnails = _worker_templates[key]
+    except KeyError:
+        options = dict(options)
+        markdown_cache = MarkdownCache()
+        thumbnails = ThumbnailCache(
+                options.pop('thumbnail_dir'),
+                max_bytes=options.pop('thumbnail_cache_size'))
+        template = _load_template(markdown_cache=markdown_cache,
+                                  thumbnails=thumbnails, **options)
+        _worker_templates[key] = template, markdown_cache, thumbnails
+    # computed ahead of rendering by the parent process, which has already
+    # stored them on disk
+    for key, value in html.items():
+        markdown_cache.memory.put(key, value)
+    for key, value in uris.items():
+        thumbnails.memory.put(key, value)
+    return list(_render_groups(template, groups, today))
+
+
 def dayone_export(dayone_folder, template=None, reverse=False, tags=None,
     exclude=None, before=None, after=None, format=None, template_dir=None, autobold=False,
-    nl2br=False, filename_template=""):
+    nl2br=False, filename_template="", workers=None, cache_dir=None,
+    rebuild_cache=False, incremental=False, stream=False,
+    thumbnail_cache_size=THUMBNAIL_CACHE_SIZE, lazy=False, stats=None,
+    journal=None):
     """Render a template using entries from a Day One journal.
 
     :param dayone_folder: Name of Day One folder; generally ends in ``.dayone``.
@@ -329,49 +1217,124 @@ def dayone_export(dayone_folder, template=None, reverse=False, tags=None,
     :param filename_template: An eventual filename, which can include strftime formatting codes.
                 Each time the result of formatting an entry's timestamp with this changes,
                 a new result will be returned.
+    :param workers: Number of worker processes used to parse the journal,
+                    to convert markdown if the template uses the
+                    ``markdown`` filter, and to encode photos if it uses
+                    the ``imgbase64`` filter. If *filename_template*
+                    splits the journal into several files, they are also
+                    rendered by the worker processes.
+    :type workers: int
+    :param cache_dir: Directory in which to cache parsed entries, converted
+                      markdown and encoded photos between runs. By default,
+                      nothing is cached on disk.
+    :type cache_dir: string
+    :param rebuild_cache: Ignore previously cached entries and outputs.
+    :type rebuild_cache: bool
+    :param incremental: Only return outputs whose entries, template or options
+                        have changed since the last export with the same
+                        *filename_template*, or whose file no longer exists.
+                        Requires *cache_dir*.
+    :type incremental: bool
+    :param thumbnail_cache_size: Maximum number of bytes of encoded images
+                                 to keep in memory and, if *cache_dir* is
+                                 given, on disk, for the ``imgbase64``
+                                 filter.
+    :type thumbnail_cache_size: int
+    :param stream: Return each filled in template as an iterator over
+                   pieces of the output, rendered as it is consumed, instead
+                   of as a single string.
+    :type stream: bool
+    :param lazy: Only read the rest of an entry file, beyond the fields
+                 needed for sorting and filtering, if the entry is exported.
+                 This is faster when most entries are filtered out.
+    :type lazy: bool
+    :param stats: If given, the time spent in each stage of the export
+                  (parsing, filtering, rendering, and each template filter)
+                  is added to it as the export progresses.
+    :type stats: :class:`dayone_export.stats.Stats`
+    :param journal: The journal of *dayone_folder*, if it has already been
+                    parsed by :func:`parse_journal`. The entry files are
+                    then not read again.
+    :type journal: :class:`Journal`
     :returns: Iterator yielding (filename, filled_in_template) as strings on each iteration.
     """
 
-    # figure out which template to use
-    loader, template = _determine_inheritance(template, template_dir, format)
-
-    # custom latex template syntax
-    custom_syntax = {}
-    if os.path.splitext(template)[1] == ".tex":
-        custom_syntax = {'block_start_string': r'\CMD{',
-                         'block_end_string': '}',
-                         'variable_start_string': r'\VAR{',
-                         'variable_end_string': '}',
-                         }
-    # define jinja environment
-    env = jinja2.Environment(loader=loader, trim_blocks=True, **custom_syntax)
-
-    # filters
-    env.filters['markdown'] = filters.markdown_filter(autobold=autobold)
-    env.filters['format'] = filters.format
-    env.filters['escape_tex'] = filters.escape_tex
-    env.filters['imgbase64'] = partial(filters.imgbase64,
-      dayone_folder=dayone_folder)
-
-
-    # load template
-    template = env.get_template(template)
+    output = dict(filename_template=filename_template, template=template,
+                  format=format)
+    return dayone_export_many(dayone_folder, [output], reverse=reverse,
+        tags=tags, exclude=exclude, before=before, after=after,
+        template_dir=template_dir, autobold=autobold, nl2br=nl2br,
+        workers=workers, cache_dir=cache_dir, rebuild_cache=rebuild_cache,
+        incremental=incremental, stream=stream,
+        thumbnail_cache_size=thumbnail_cache_size, lazy=lazy, stats=stats,
+        journal=journal)
+
+
+def dayone_export_many(dayone_folder, outputs, reverse=False, tags=None,
+    exclude=None, before=None, after=None, template_dir=None, autobold=False,
+    nl2br=False, workers=None, cache_dir=None, rebuild_cache=False,
+    incremental=False, stream=False, thumbnail_cache_size=THUMBNAIL_CACHE_SIZE,
+    lazy=False, stats=None, journal=None):
+    """Render several templates using entries from a Day One journal.
+
+    The journal is parsed and filtered only once, then each template is
+    rendered in turn.
+
+    :param outputs: The outputs to render. Each output is a dictionary with
+                    any of the keys ``filename_template``, ``template`` and
+                    ``format``, which have the same meaning as the arguments
+                    of :func:`dayone_export`.
+    :type outputs: list of dicts
+    :param workers: Number of worker processes used to parse the journal,
+                    convert markdown and encode photos. If there is more
+                    than one output file, the files are also rendered
+                    by the worker processes.
+    :type workers: int
+    :returns: Iterator yielding (filename, filled_in_template) for each
+              output in turn.
+
+    The other arguments are as for :func:`dayone_export`.
+    """
+    if stats is None:
+        stats = NO_STATS
+
+    outputs = [dict(filename_template=output.get('filename_template', ""),
+                    template=output.get('template'),
+                    format=output.get('format'))
+               for output in outputs]
+
+    if incremental and cache_dir is None:
+        raise ValueError("Incremental export requires a cache directory")
+
+    # shared by all templates
+    markdown_cache = MarkdownCache(None if cache_dir is None else cache_path(
+        cache_dir, 'markdown', os.path.abspath(dayone_folder)))
+    thumbnail_dir = None
+    if cache_dir is not None:
+        thumbnail_dir = os.path.join(cache_dir, 'thumbnails')
+    thumbnails = ThumbnailCache(thumbnail_dir, max_bytes=thumbnail_cache_size)
+
+    # load templates
+    templates = [_load_template(dayone_folder, output['template'],
+                                template_dir, output['format'],
+                                autobold=autobold, nl2br=nl2br,
+                                markdown_cache=markdown_cache,
+                                thumbnails=thumbnails, stats=stats,
+                                cache_dir=cache_dir)
+                 for output in outputs]
 
     # parse journal
-    j = parse_journal(dayone_folder)
+    j = journal
+    if j is None:
+        cache = None
+        if cache_dir is not None:
+            cache = EntryCache(dayone_folder, cache_dir, rebuild=rebuild_cache)
+        j = parse_journal(dayone_folder, workers=workers, cache=cache,
+                          lazy=lazy, stats=stats)
 
     # filter and manipulate based on options
-    default_tz = j[-1]["Date"].tzinfo
-    after = _convert_to_utc(after, default_tz)
-    before = _convert_to_utc(before, default_tz)
-    j = _filter_by_date(j, after=after, before=before)
-    if tags is not None:
-        j = _filter_by_tag(j, tags)
-    if exclude is not None:
-        j = _exclude_tags(j, exclude)
-    if reverse:
-        j.reverse()
-
+    j = _select_entries(j, tags=tags, exclude=exclude, before=before,
+                        after=after, reverse=reverse, stats=stats)
 
     # Split into groups, possibly of length one
     # Generate a new output for each time the 'filename_template' changes.
@@ -382,10 +1345,86 @@ def dayone_export(dayone_folder, template=None, reverse=False, tags=None,
     # The traceback is helpful, so I'm letting it through
     # it might be nice to clean up the error message, someday
 
-    output_groups = defaultdict(list)
-    for e in j:
-        output_groups[e['Date'].strftime(filename_template)].append(e)
+    # Only changed groups are rendered in incremental mode.
+    groups = []
+    caches = []
+    for output, template in zip(outputs, templates):
+        output_cache = None
+        output_groups = ((k, None, group) for k, group
+                         in _group_entries(j, output['filename_template']))
+        if incremental:
+            output_cache = OutputCache(output['filename_template'], cache_dir,
+                                       rebuild=rebuild_cache)
+            context = (_template_signature(template), reverse, autobold, nl2br)
+            output_groups = _changed_groups(output_groups, output_cache,
+                                            context, dayone_folder)
+        groups.append(output_groups)
+        caches.append(output_cache)
 
     today = datetime.today()
-    for k in output_groups:
-        yield k, template.render(journal=output_groups[k], today=today)
+    uses_markdown, sizes = False, set()
+    if workers is not None and workers > 1:
+        groups = [list(output_groups) for output_groups in groups]
+
+        # convert markdown and encode photos in parallel ahead of
+        # rendering, for the groups that will be rendered
+        entries = [entry for output_groups in groups
+                   for _, _, group in output_groups for entry in group]
+        uses_markdown = any(_uses_filter(template.environment, template.name,
+                                         'markdown')
+                            for template in templates)
+        if uses_markdown:
+            with stats.timer('convert markdown'):
+                _convert_markdown(entries, autobold, nl2br, markdown_cache,
+                                  workers)
+        for template in templates:
+            sizes.update(_imgbase64_sizes(template.environment, template.name))
+        if sizes:
+            with stats.timer('encode photos'):
+                _encode_photos(entries, dayone_folder, sizes, thumbnails,
+                               workers)
+    if workers is not None and workers > 1 and sum(map(len, groups)) > 1:
+        # render batches of groups in worker processes, and put the
+        # results back together in order
+        batches, counts = [], []
+        for output, output_groups in zip(outputs, groups):
+            options = dict(dayone_folder=dayone_folder,
+                           template=output['template'],
+                           template_dir=template_dir,
+                           format=output['format'],
+                           autobold=autobold, nl2br=nl2br,
+                           thumbnail_dir=thumbnail_dir,
+                           thumbnail_cache_size=thumbnail_cache_size,
+                           cache_dir=cache_dir)
+            size = max(1, len(output_groups) // (workers * 4))
+            starts = range(0, len(output_groups), size)
+            batches.extend((options, output_groups[i:i + size])
+                           for i in starts)
+            counts.append(len(starts))
+        # the precomputed values are looked up as the pool takes each job,
+        # rather than all held in memory at once
+        jobs = ((options, batch, today,
+                 _precomputed(batch, uses_markdown, sizes, dayone_folder,
+                              autobold, nl2br, markdown_cache, thumbnails))
+                for options, batch in batches)
+        results = stats.iterate('render',
+                                _pool_imap(_render_job, jobs, workers))
+        rendered = [chain.from_iterable(islice(results, count))
+                    for count in counts]
+    else:
+        rendered = [_render_groups(template, output_groups, today, stream,
+                                   stats)
+                    for template, output_groups in zip(templates, groups)]
+
+    for output_cache, results in zip(caches, rendered):
+        for k, digest, result in results:
+            if stream and isinstance(result, compat.string_types):
+                result = iter([result])
+            yield k, result
+            if output_cache is not None:
+                # the caller has now written the output
+                output_cache.update(k, digest)
+        if output_cache is not None:
+            output_cache.save()
+
+    markdown_cache.save()
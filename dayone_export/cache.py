@@ -0,0 +1,421 @@
+# Copyright (c) 2012, Nathan Grigg
+# All rights reserved.
+# BSD License
+
+"""Persistent caches, stored by default in ``~/.dayone_export/cache``.
+
+Caches are a speedup only. If a cache file is missing, unreadable or was
+written by a different version of this module, it is silently ignored.
+"""
+
+from collections import OrderedDict
+import errno
+import hashlib
+import os
+import pickle
+import tempfile
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~/.dayone_export'), 'cache')
+
+# Increase this whenever the format of the cached data changes.
+CACHE_VERSION = 1
+
+# Default maximum size of the thumbnail cache, in bytes.
+THUMBNAIL_CACHE_SIZE = 100 * 2**20
+
+# Maximum size of converted markdown kept in memory, in bytes.
+MARKDOWN_CACHE_SIZE = 50 * 2**20
+
+# Maximum total length of formatted dates kept in memory.
+FORMAT_CACHE_SIZE = 2**20
+
+
+def cache_path(cache_dir, kind, key):
+    """Return the path of the cache file of the given kind for key."""
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '{0}-{1}.pickle'.format(kind, digest))
+
+
+def load_pickle(path):
+    """Load a pickled cache file, returning None if it is not usable."""
+    try:
+        with open(path, 'rb') as f:
+            version, obj = pickle.load(f)
+    except Exception:
+        return None
+    if version != CACHE_VERSION:
+        return None
+    return obj
+
+
+def save_pickle(path, obj):
+    """Atomically pickle obj to path, ignoring errors.
+
+    The file is written to a temporary file and renamed into place, so that
+    a concurrent reader never sees a partial file.
+    """
+    folder = os.path.dirname(path)
+    try:
+        os.makedirs(folder)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            return
+
+    try:
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((CACHE_VERSION, obj), f, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+class EntryCache(object):
+    """Parsed contents of the entry files of one journal.
+
+    :param foldername: The Day One folder the cache belongs to.
+    :param cache_dir: Directory in which to store the cache.
+    :param rebuild: If true, ignore any existing cached data.
+
+    Each entry file's plist data is stored together with the file's
+    modification time and size, and is only reused if both are unchanged.
+    """
+
+    def __init__(self, foldername, cache_dir=DEFAULT_CACHE_DIR, rebuild=False):
+        self.path = cache_path(
+                cache_dir, 'entries', os.path.abspath(foldername))
+        self.entries = None if rebuild else load_pickle(self.path)
+        if self.entries is None:
+            self.entries = {}
+        self.changed = rebuild
+        self.seen = set()
+
+    @staticmethod
+    def _signature(filename):
+        stat = os.stat(filename)
+        return stat.st_mtime, stat.st_size
+
+    def get(self, filename):
+        """Return the cached data for filename, or None if it is stale."""
+        key = os.path.basename(filename)
+        self.seen.add(key)
+        try:
+            signature, data = self.entries[key]
+        except KeyError:
+            return None
+        if signature != self._signature(filename):
+            return None
+        return data
+
+    def put(self, filename, data):
+        """Store the data for filename."""
+        key = os.path.basename(filename)
+        self.seen.add(key)
+        self.entries[key] = (self._signature(filename), data)
+        self.changed = True
+
+    def save(self):
+        """Write the cache to disk, dropping files that no longer exist."""
+        for key in set(self.entries) - self.seen:
+            del self.entries[key]
+            self.changed = True
+        if self.changed:
+            save_pickle(self.path, self.entries)
+            self.changed = False
+
+
+def _canonical(value):
+    """Return a representation of value that does not depend on dict order."""
+    if isinstance(value, dict):
+        return sorted((k, _canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def _photo_signature(dayone_folder, entry):
+    """Return the modification time and size of an entry's photo, if any."""
+    if dayone_folder is None or 'Photo' not in entry:
+        return None
+    try:
+        stat = os.stat(os.path.join(dayone_folder, entry['Photo']))
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def entries_digest(entries, context='', dayone_folder=None):
+    """Return a hash of the data of a list of entries.
+
+    :param context: Additional information that affects the output, such as
+                    the template and rendering options.
+    :param dayone_folder: If given, the modification time and size of each
+                          entry's photo in this folder are part of the hash,
+                          so that edited photos change it.
+    """
+    sha = hashlib.sha1(repr(context).encode('utf-8'))
+    for entry in entries:
+        sha.update(repr(_canonical(entry.data)).encode('utf-8'))
+        sha.update(repr(_photo_signature(dayone_folder, entry)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class OutputCache(object):
+    """Content hashes of the files written by an export.
+
+    :param filename_template: The (strftime-style) name of the output files.
+    :param cache_dir: Directory in which to store the cache.
+    :param rebuild: If true, ignore any existing hashes.
+
+    Each output file is stored with a hash of the entries and options used
+    to render it, so that unchanged files need not be rendered again.
+    """
+
+    def __init__(self, filename_template, cache_dir=DEFAULT_CACHE_DIR,
+                 rebuild=False):
+        self.path = cache_path(
+                cache_dir, 'outputs', os.path.abspath(filename_template))
+        self.hashes = None if rebuild else load_pickle(self.path)
+        if self.hashes is None:
+            self.hashes = {}
+        self.seen = set()
+
+    def unchanged(self, filename, digest):
+        """Whether filename exists and was last written with digest."""
+        self.seen.add(filename)
+        return self.hashes.get(filename) == digest and os.path.exists(filename)
+
+    def update(self, filename, digest):
+        """Record that filename has been written with digest."""
+        self.seen.add(filename)
+        self.hashes[filename] = digest
+
+    def forget(self):
+        """Remove the hashes from disk, so that every file is written again."""
+        self.hashes = {}
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def save(self):
+        """Write the hashes to disk, dropping files that were not exported."""
+        self.hashes = dict((k, v) for k, v in self.hashes.items()
+                           if k in self.seen)
+        save_pickle(self.path, self.hashes)
+
+
+class LRUCache(object):
+    """An in-memory mapping that forgets the least recently used items.
+
+    :param max_bytes: Maximum total length of the stored values.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        """Return the value for key, or None."""
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return None
+        self.items[key] = value
+        return value
+
+    def clear(self):
+        """Remove all items."""
+        self.items.clear()
+        self.size = 0
+
+    def put(self, key, value):
+        """Store value, evicting old items if necessary."""
+        if key in self.items:
+            self.size -= len(self.items.pop(key))
+        if len(value) > self.max_bytes:
+            return
+        self.items[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, old = self.items.popitem(last=False)
+            self.size -= len(old)
+
+
+class ThumbnailCache(object):
+    """Encoded images (data URIs), kept in memory and on disk.
+
+    :param cache_dir: Directory in which to store the images, or None to
+                      only keep them in memory.
+    :param max_bytes: Approximate maximum total size of the stored images,
+                      both in memory and on disk. When the limit is reached,
+                      the least recently used images are removed.
+
+    Images are stored by a hash of the photo's path and modification time,
+    the maximum thumbnail size and the output format.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=THUMBNAIL_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory = LRUCache(max_bytes)
+        self.disk_size = None
+
+    @staticmethod
+    def key(path, max_size, fmt):
+        """Return the cache key for a photo."""
+        mtime = os.path.getmtime(path)
+        key = repr((os.path.abspath(path), mtime, max_size, fmt))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.txt')
+
+    def get(self, key):
+        """Return the data URI for key, or None."""
+        value = self.memory.get(key)
+        if value is not None or self.cache_dir is None:
+            return value
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = f.read().decode('ascii')
+            # mark as recently used
+            os.utime(self._path(key), None)
+        except (IOError, OSError):
+            return None
+        self.memory.put(key, value)
+        return value
+
+    def has(self, key):
+        """Return whether the data URI for key is stored.
+
+        Unlike :meth:`get`, this does not read the image from disk.
+        """
+        if key in self.memory.items:
+            return True
+        return (self.cache_dir is not None and
+                os.path.exists(self._path(key)))
+
+    def put(self, key, value):
+        """Store the data URI for key."""
+        self.memory.put(key, value)
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value.encode('ascii'))
+            if os.name == 'nt' and os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+            os.rename(tmp, self._path(key))
+        except (IOError, OSError):
+            return
+        if self.disk_size is None:
+            self.disk_size = self._evict()
+        else:
+            self.disk_size += len(value)
+            if self.disk_size > self.max_bytes:
+                self.disk_size = self._evict()
+
+    def _evict(self):
+        """Remove the least recently used files over the size limit.
+
+        Returns the total size of the remaining files.
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.txt'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+
+# Converted markdown shared by all MarkdownCache objects in this process.
+_markdown_memory = LRUCache(MARKDOWN_CACHE_SIZE)
+
+
+class MarkdownCache(object):
+    """Markdown converted to html, by a hash of the text and options.
+
+    :param path: File in which to store the converted markdown between runs,
+                 or None to only keep it in memory.
+    :param max_bytes: Maximum total length of the html stored in the file.
+
+    Converted markdown is kept in memory for the life of the process, so
+    that it can be reused by several exports. When the stored html is over
+    *max_bytes*, the least recently used html is discarded.
+    """
+
+    def __init__(self, path=None, max_bytes=MARKDOWN_CACHE_SIZE):
+        self.memory = _markdown_memory
+        self.path = path
+        self.max_bytes = max_bytes
+        stored = None if path is None else load_pickle(path)
+        # in order of use, oldest first
+        self.stored = OrderedDict(stored or ())
+        self.changed = False
+        self.used = set()
+
+    @staticmethod
+    def key(text, options):
+        """Return the cache key for text converted with the given options."""
+        sha = hashlib.sha1(repr(options).encode('utf-8'))
+        sha.update(text.encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Return the html for key, or None."""
+        html = self.memory.get(key)
+        if html is None:
+            html = self.stored.get(key)
+            if html is not None:
+                self.memory.put(key, html)
+        if html is not None:
+            self.used.add(key)
+        return html
+
+    def put(self, key, html):
+        """Store the html for key."""
+        self.memory.put(key, html)
+        self.used.add(key)
+        if self.path is not None:
+            self.stored[key] = html
+            self.changed = True
+
+    def save(self):
+        """Write the cache to disk, if anything was added."""
+        if self.path is None or not self.changed:
+            return
+        # html used by this run is the most recently used
+        for key in self.used:
+            if key in self.stored:
+                self.stored[key] = self.stored.pop(key)
+        size = sum(len(html) for html in self.stored.values())
+        while size > self.max_bytes:
+            _, html = self.stored.popitem(last=False)
+            size -= len(html)
+        save_pickle(self.path, self.stored)
+        self.changed = False
+        self.used = set()
@@ -3,12 +3,16 @@
 # Command line interface to dayone_export
 #
 # For help, run `dayone_export --help`
+#
+# dateutil, jinja2 and the server are imported when they are needed, so that the
+# command starts quickly
 
-from . import dayone_export, VERSION, compat, PlistError
-import dateutil.parser
-import jinja2
+from . import dayone_export, dayone_export_many, VERSION, compat, PlistError
+from . import cache
+from . import watch
+from .stats import Stats, NO_STATS
+from .writer import Writer, atomic_write
 import argparse
-import codecs
 import locale
 import os
 import sys
@@ -33,15 +37,18 @@ def parse_args(args=None):
       usage="%(prog)s [--output FILE] [opts] journal",
       epilog="""If the Day One package has photos, you may need to copy
         the "photos" folder from the package into the same directory
-        as the output file.""")
+        as the output file. To export several files at once, repeat
+        the --output and --template options. To keep journals and
+        templates in memory between exports, start a server with
+        `%(prog)s serve SOCKET` and export with --server SOCKET.""")
     parser.add_argument('journal', help="path to Day One journal package")
-    parser.add_argument('--output', metavar="FILE", default="",
+    parser.add_argument('--output', metavar="FILE", action="append",
       help="file to write (default print to stdout). "
             "Using strftime syntax will produce multiple "
             "output files with entries grouped by date.")
     parser.add_argument('--format', metavar="FMT",
       help="output format (default guess from output file extension)")
-    parser.add_argument('--template', metavar="NAME",
+    parser.add_argument('--template', metavar="NAME", action="append",
       help="name or file of template to use")
     parser.add_argument('--template-dir', metavar="DIR",
       help='location of templates (default ~/.dayone_export)')
@@ -59,29 +66,129 @@ def parse_args(args=None):
       help="autobold first lines (titles) of posts")
     parser.add_argument('--nl2br', action="store_true",
       help="convert each new line to a <br>")
+    parser.add_argument('--jobs', metavar='N', type=int,
+      help="number of processes used to parse the journal, convert "
+           "markdown and encode photos (default 1)")
+    parser.add_argument('--no-cache', action="store_true",
+      help="do not cache parsed entries in ~/.dayone_export/cache")
+    parser.add_argument('--rebuild-cache', action="store_true",
+      help="ignore and replace previously cached entries")
+    parser.add_argument('--thumbnail-cache-size', metavar='MB', type=int,
+      default=cache.THUMBNAIL_CACHE_SIZE // 2**20,
+      help="maximum size of cached images for imgbase64 (default %(default)s)")
+    parser.add_argument('--incremental', action="store_true",
+      help="only write output files whose entries have changed")
+    parser.add_argument('--stats', action="store_true",
+      help="print the time spent in each stage of the export to stderr")
+    parser.add_argument('--watch', action="store_true",
+      help="keep running, and export again whenever the journal changes "
+           "(implies --incremental)")
+    parser.add_argument('--server', metavar='SOCKET',
+      help="send the export to a server started with "
+           "`dayone_export serve SOCKET`")
     parser.add_argument('--locale', help=argparse.SUPPRESS, default="")
 
     parser.add_argument('--version', action='version', version=VERSION)
     return parser.parse_args(args)
 
+
+def parse_serve_args(args=None):
+    """Parse command line arguments of `dayone_export serve`"""
+    parser = argparse.ArgumentParser(
+      prog="dayone_export serve",
+      description="Answer exports sent with --server, keeping journals and "
+                  "templates in memory between them")
+    parser.add_argument('socket', help="path of the Unix socket to listen on")
+    return parser.parse_args(args)
+
 # command line interface
 def run(args=None):
-    args = parse_args(args)
+    argv = sys.argv[1:] if args is None else list(args)
+    if argv[:1] == ['serve'] and not os.path.exists('serve'):
+        # otherwise it is a journal named serve
+        return serve(argv[1:])
+
+    args = parse_args(argv)
+    if args.server:
+        if args.watch:
+            return "The --watch option cannot be used with --server"
+        return send(args.server, args)
+
     locale.setlocale(locale.LC_ALL, args.locale)
+    error, outputs, options = export_options(args)
+    if error:
+        return error
+
+    error = export(args.journal, outputs, options, args.stats)
+    if error or not args.watch:
+        return error
+
+    # only changed entries are parsed again, and only changed files are
+    # written again
+    options['rebuild_cache'] = False
+    watcher = watch.watcher(args.journal)
+    try:
+        while True:
+            changed = watcher.wait()
+            sys.stderr.write("{0} changed file(s), exporting\n".format(
+                             len(changed)))
+            error = export(args.journal, outputs, options, args.stats)
+            if error:
+                # maybe a file was only partly synced; try again next time
+                sys.stderr.write(error + '\n')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def export_options(args):
+    """Check the parsed command line arguments and convert them.
+
+    Returns an error message or None, the outputs and the options of
+    the export.
+    """
+    # pair up outputs and templates
+    outputs = args.output or [""]
+    templates = args.template or [None]
+    if len(outputs) == 1:
+        outputs = outputs * len(templates)
+    elif len(templates) == 1:
+        templates = templates * len(outputs)
+    elif len(templates) != len(outputs):
+        return "Use one --template for each --output", None, None
+    named = [os.path.abspath(output) for output in outputs if output]
+    if len(set(named)) != len(named):
+        # each render would replace the previous one
+        return "Use a different --output for each --template", None, None
 
     # determine output format
-    if args.format is None:
-        args.format = os.path.splitext(args.output)[1][1:] if args.output \
-                      else 'html'
-    if args.format.lower() in ['md', 'markdown', 'mdown', 'mkdn']:
-        args.format = 'md'
+    formats = []
+    for output in outputs:
+        fmt = args.format
+        if fmt is None:
+            fmt = os.path.splitext(output)[1][1:] if output else 'html'
+        if fmt.lower() in ['md', 'markdown', 'mdown', 'mkdn']:
+            fmt = 'md'
+        formats.append(fmt)
 
     # Check journal files exist
     args.journal = os.path.expanduser(args.journal)
     if not os.path.exists(args.journal):
-        return "File not found: " + args.journal
+        return "File not found: " + args.journal, None, None
     if not os.path.exists(os.path.join(args.journal, 'entries')):
-        return "Not a valid Day One package: " + args.journal
+        return "Not a valid Day One package: " + args.journal, None, None
+
+    if args.watch:
+        args.incremental = True
+    if args.incremental:
+        option = "--watch" if args.watch else "--incremental"
+        if not all(outputs):
+            return ("The {0} option requires --output".format(option),
+                    None, None)
+        if args.no_cache:
+            return ("The {0} option cannot be used with --no-cache".format(
+                    option), None, None)
 
     # tags
     tags = args.tags
@@ -95,44 +202,183 @@ def run(args=None):
         excluded_tags = [tag.strip() for tag in excluded_tags.split(',')]
 
     # parse before and after date
+    import dateutil.parser
     dates = [args.before, args.after]
     for i, date in enumerate(dates):
         if date:
             try:
                 dates[i] = dateutil.parser.parse(date)
             except (ValueError, OverflowError):
-                return "Unable to parse date '{0}'".format(date)
+                return "Unable to parse date '{0}'".format(date), None, None
     before, after = dates
 
-    generator = dayone_export(
-            args.journal,
-            template=args.template,
+    options = dict(
             reverse=args.reverse,
             tags=tags,
             exclude=excluded_tags,
             before=before,
             after=after,
-            format=args.format,
             template_dir=args.template_dir,
             autobold=args.autobold,
             nl2br=args.nl2br,
-            filename_template=args.output)
+            workers=args.jobs,
+            cache_dir=None if args.no_cache else cache.DEFAULT_CACHE_DIR,
+            rebuild_cache=args.rebuild_cache,
+            incremental=args.incremental,
+            stream=True,
+            thumbnail_cache_size=args.thumbnail_cache_size * 2**20)
+    outputs = [dict(filename_template=output, template=template, format=fmt)
+               for output, template, fmt in zip(outputs, templates, formats)]
+    return None, outputs, options
+
+
+def export(journal, outputs, options, print_stats=False, stdout=None,
+           stderr=None, journals=None):
+    """Export the journal to each of the outputs, and write the files.
+
+    Returns an error message, or None.
+
+    Files are written atomically. If there are several files per output,
+    they are written by background threads while the next one is rendered.
+    Output without a filename is passed as bytes to *stdout*, and the
+    stats to *stderr* (by default, they are printed). If *journals* (a
+    :class:`dayone_export.server.JournalMemory`) is given, the journal is
+    only parsed again if it has changed.
+    """
+    import jinja2
+    if stdout is None:
+        stdout = compat.print_bytes
+    if stderr is None:
+        stderr = sys.stderr.write
+    stats = Stats() if print_stats else NO_STATS
+
+    # files of outputs that are split by date are written in the
+    # background; single files are streamed as they are rendered
+    single_files = set(output['filename_template'] for output in outputs
+                       if '%' not in output['filename_template'])
+    writer = None
+    if any('%' in output['filename_template'] for output in outputs):
+        writer = Writer(stats=stats)
 
     try:
+        parsed = None
+        if journals is not None:
+            parsed = journals.get(journal, options['workers'],
+                                  options['cache_dir'],
+                                  options['rebuild_cache'], stats)
+        if len(outputs) == 1:
+            generator = dayone_export(journal, stats=stats, journal=parsed,
+                                      **dict(outputs[0], **options))
+        else:
+            generator = dayone_export_many(journal, outputs, stats=stats,
+                                           journal=parsed, **options)
 
         # Output is a generator returning each file's name and contents one at a time
-        for filename, output in generator:
-            if args.output:
-                with codecs.open(filename, 'w', encoding='utf-8') as f:
-                    f.write(output)
-            else:
-                compat.print_bytes(output.encode('utf-8'))
-                compat.print_bytes("\n".encode('utf-8'))
+        # Each file's contents is rendered piece by piece as it is written
+        try:
+            for filename, chunks in generator:
+                if filename and filename not in single_files:
+                    writer.write(filename, chunks)
+                elif filename:
+                    atomic_write(filename, chunks, stats)
+                else:
+                    write = stats.wrap('write', stdout)
+                    for chunk in chunks:
+                        data = chunk.encode('utf-8')
+                        write(data)
+                        stats.add('write', calls=0, bytes=len(data))
+                    stdout("\n".encode('utf-8'))
+        finally:
+            if writer is not None:
+                writer.close()
 
     except jinja2.TemplateNotFound as err:
         return template_not_found_message(err)
     except PlistError as err:
         return str(err)
+    except (IOError, OSError):
+        if options['incremental']:
+            # files may have been recorded as written before they failed
+            for output in outputs:
+                cache.OutputCache(output['filename_template'],
+                                  options['cache_dir']).forget()
+        raise
+
+    if print_stats:
+        stderr(stats.report() + '\n')
+
+
+def absolute_paths(args):
+    """Make the paths in the parsed command line arguments absolute.
+
+    A template name without a directory is only treated as a path if
+    there is such a file in the current directory, since otherwise it is
+    looked up in the template directories.
+    """
+    args.journal = os.path.abspath(os.path.expanduser(args.journal))
+    if args.output:
+        args.output = [os.path.abspath(output) if output else output
+                       for output in args.output]
+    if args.template:
+        args.template = [os.path.abspath(template)
+                         if os.path.dirname(template) or
+                            os.path.isfile(template) else template
+                         for template in args.template]
+    if args.template_dir:
+        args.template_dir = os.path.abspath(args.template_dir)
+    return args
+
+
+def send(path, args):
+    """Send an export to the server at path, and print its output.
+
+    The server has its own working directory, so paths are made absolute
+    before the arguments are sent.
+    """
+    from . import server
+    import socket
+    try:
+        response = server.request(os.path.expanduser(path),
+                                  vars(absolute_paths(args)))
+    except socket.error as err:
+        return "Unable to connect to server at {0}: {1}".format(path, err)
+    if response.get('output'):
+        compat.print_bytes(response['output'].encode('utf-8'))
+    if response.get('stats'):
+        sys.stderr.write(response['stats'])
+    return response.get('error')
+
+
+def answer(options, journals):
+    """Run an export sent to the server, and return the response.
+
+    The options are the parsed command line arguments, as a dictionary.
+    """
+    args = argparse.Namespace(**options)
+    if args.watch:
+        return dict(error="The --watch option cannot be used with --server")
+    locale.setlocale(locale.LC_ALL, args.locale)
+    error, outputs, options = export_options(args)
+    if error:
+        return dict(error=error)
+
+    output, report = [], []
+    error = export(args.journal, outputs, options, args.stats,
+                   stdout=output.append, stderr=report.append,
+                   journals=journals)
+    return dict(error=error,
+                output=b''.join(output).decode('utf-8'),
+                stats=''.join(report) or None)
+
+
+def serve(argv):
+    """Run the export server."""
+    from . import server
+    import socket
+    args = parse_serve_args(argv)
+    if not hasattr(socket, 'AF_UNIX'):
+        return "The server requires Unix sockets"
+    return server.serve(os.path.expanduser(args.socket), answer)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ PY2 = sys.version_info[0] == 2
 if PY2:
     string_types = (str, unicode)
     print_bytes = lambda s: sys.stdout.write(s)
+    intern = intern
 else:
     string_types = (str,)
     print_bytes = lambda s: sys.stdout.buffer.write(s)
+    intern = sys.intern
@@ -2,14 +2,19 @@
 # All rights reserved.
 # BSD License
 
+# markdown, pytz and PIL are slow to import, so they are imported when
+# they are first needed
+
+from . import compat
+from .cache import LRUCache, FORMAT_CACHE_SIZE
 import base64
+from datetime import datetime
 from io import BytesIO
 import locale
-import markdown
 import os
-import pytz
 import re
 import sys
+import threading
 
 MARKER = 'zpoqjd_marker_zpoqjd'
 RE_PERCENT_MINUS = re.compile(r'(?<!%)%-')
@@ -43,8 +48,7 @@ warn_once = WarnOnce({
 # Markdown
 #############################
 
-def markdown_filter(autobold=False, nl2br=False):
-    """Returns a markdown filter"""
+def _markdown_extensions(autobold, nl2br):
     extensions = ['footnotes',
                   'tables',
                   'smart_strong',
@@ -62,41 +66,184 @@ def markdown_filter(autobold=False, nl2br=False):
     if nl2br:
         extensions.append('nl2br')
 
-    md = markdown.Markdown(extensions=extensions,
+    return extensions
+
+
+def _markdown(autobold, nl2br):
+    import markdown
+    return markdown.Markdown(extensions=_markdown_extensions(autobold, nl2br),
       extension_configs={'footnotes': [('UNIQUE_IDS', True)]},
       output_format='html5')
 
+
+def markdown_options(autobold=False, nl2br=False):
+    """Return the options that are part of the cache key of converted text"""
+    import markdown
+    return (markdown.version, _markdown_extensions(autobold, nl2br))
+
+
+# Markdown instances of each thread, by options, since they are slow to
+# create. A Markdown instance cannot convert two texts at once.
+_local = threading.local()
+
+def _converter(autobold, nl2br):
+    converters = _local.__dict__.setdefault('converters', {})
+    try:
+        return converters[(autobold, nl2br)]
+    except KeyError:
+        md = converters[(autobold, nl2br)] = _markdown(autobold, nl2br)
+        return md
+
+
+def markdown_filter(autobold=False, nl2br=False, cache=None):
+    """Returns a markdown filter
+
+    If a :class:`dayone_export.cache.MarkdownCache` is given, converted text
+    is stored in it and reused.
+    """
+    # The Markdown instances are shared, but footnote ids are numbered by
+    # each filter, as if it had its own instance.
+    count = [0]
+
     def markup(text, *args, **kwargs):
+        md = _converter(autobold, nl2br)
+        footnotes = [ext for ext in md.registeredExtensions
+                     if hasattr(ext, 'unique_prefix')]
+        for ext in footnotes:
+            ext.unique_prefix = count[0]
         md.reset()
+        for ext in footnotes:
+            count[0] = ext.unique_prefix
         return md.convert(text)
 
-    return markup
+    if cache is None:
+        return markup
+
+    options = markdown_options(autobold, nl2br)
+
+    def cached_markup(text, *args, **kwargs):
+        # footnote ids depend on how many texts have been converted
+        if '[^' in text:
+            return markup(text)
+        key = cache.key(text, options)
+        html = cache.get(key)
+        if html is None:
+            html = markup(text)
+            cache.put(key, html)
+        return html
+
+    return cached_markup
+
+
+def markdown_job(job):
+    """Convert an (autobold, nl2br, text) triple for a pool of worker
+    processes.
+
+    Each process makes one Markdown instance for each set of options.
+    """
+    autobold, nl2br, text = job
+    md = _converter(autobold, nl2br)
+    md.reset()
+    return md.convert(text)
 
 
 #############################
 # Date formatting
 #############################
+_timezones = {}
+_UTC = object()
+
+def timezone(name, default=_UTC):
+    """Return the pytz time zone with the given name.
+
+    If there is no such time zone, return *default* (by default UTC), or
+    raise pytz.UnknownTimeZoneError if *default* is None. Time zones (and
+    unknown names) are remembered, since a journal uses only a few.
+    """
+    try:
+        tz = _timezones[name]
+    except KeyError:
+        import pytz
+        try:
+            tz = pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            tz = None
+        _timezones[name] = tz
+    if tz is None:
+        import pytz
+        if default is None:
+            raise pytz.UnknownTimeZoneError(name)
+        return pytz.utc if default is _UTC else default
+    return tz
+
+
+# Formatted dates, by date, time zone, format and locale.
+_formatted = LRUCache(FORMAT_CACHE_SIZE)
+
 def format(value, fmt='%A, %b %-d, %Y', tz=None):
     """Format a date or time."""
 
-    if tz:
-        value = value.astimezone(pytz.timezone(tz))
-    try:
-        formatted = value.strftime(fmt)
-    except ValueError:
-        formatted = _strftime_portable(value, fmt)
+    # the time zone is part of the key because dates in different time
+    # zones are equal if they are the same instant
+    key = (value, getattr(value, 'tzinfo', None), fmt, tz,
+           locale.setlocale(locale.LC_TIME))
+    formatted = _formatted.get(key)
+    if formatted is None:
+        if tz:
+            value = value.astimezone(timezone(tz, default=None))
+        formatted = compile_format(fmt)(value)
+        _formatted.put(key, formatted)
+    return formatted
+
 
-    # Workaround for python 2.7, which returns bytes from strftime.
+def _decode(formatted):
+    """Workaround for python 2.7, which returns bytes from strftime."""
     if not isinstance(formatted, UNICODE_TYPE):
         try:
             formatted = formatted.decode("ascii")
         except UnicodeDecodeError:
             _, encoding = locale.getlocale(locale.LC_ALL)
             formatted = formatted.decode(encoding)
-
     return formatted
 
 
+_formatters = {}
+_native_minus = None
+
+def compile_format(fmt):
+    """Return a function that formats a date or time with fmt.
+
+    Whether strftime understands ``%-`` (which removes leading zeros) is
+    checked only once, so formats that use it go straight to the portable
+    version if it does not.
+    """
+    global _native_minus
+    try:
+        return _formatters[fmt]
+    except KeyError:
+        pass
+
+    if _native_minus is None:
+        try:
+            _native_minus = datetime(2000, 1, 1).strftime('%-d') == '1'
+        except ValueError:
+            _native_minus = False
+
+    if _native_minus or not RE_PERCENT_MINUS.search(fmt):
+        def formatter(value):
+            try:
+                return _decode(value.strftime(fmt))
+            except ValueError:
+                return _decode(_strftime_portable(value, fmt))
+    else:
+        marked_fmt = RE_PERCENT_MINUS.sub(MARKER + "%", fmt)
+        def formatter(value):
+            return _decode(RE_REMOVE_MARKER.sub("", value.strftime(marked_fmt)))
+
+    _formatters[fmt] = formatter
+    return formatter
+
+
 def _strftime_portable(value, fmt='%A, %b %-d, %Y'):
     marked = value.strftime(RE_PERCENT_MINUS.sub(MARKER + "%", fmt))
     return RE_REMOVE_MARKER.sub("", marked)
@@ -105,45 +252,126 @@ def _strftime_portable(value, fmt='%A, %b %-d, %Y'):
 #############################
 # Escape Latex (http://flask.pocoo.org/snippets/55/)
 #############################
-LATEX_SUBS = (
-    (re.compile(r'\\'), r'\\textbackslashzzz'),
-    (re.compile(r'([{}_#%&$])'), r'\\\1'),
-    (re.compile(r'~'), r'\\textasciitilde{}'),
-    (re.compile(r'\^'), r'\\textasciicircum{}'),
-    (re.compile(r'"'), r"''"),
-    (re.compile(r'\.\.\.+'), r'\\ldots'),
-    (re.compile(r'\\textbackslashzzz'), r'\\textbackslash{}'),
-)
+LATEX_SUBS = [
+    ('\\', r'\textbackslash{}'),
+    ('{', r'\{'), ('}', r'\}'), ('_', r'\_'), ('#', r'\#'),
+    ('%', r'\%'), ('&', r'\&'), ('$', r'\$'),
+    ('~', r'\textasciitilde{}'),
+    ('^', r'\textasciicircum{}'),
+    ('"', "''"),
+]
+LATEX_TABLE = dict(LATEX_SUBS)
+RE_LATEX = re.compile(r'[\\{}_#%&$~^"]|\.\.\.+')
+RE_ELLIPSIS = re.compile(r'\.\.\.+')
+
+# Backslashes are first replaced by a NUL character, and at the end by
+# their escaped version, so that the other replacements do not escape
+# them (or the braces of their escaped version).
+LATEX_REPLACEMENTS = ([('\\', u'\x00')] + LATEX_SUBS[1:] +
+                      [(u'\x00', LATEX_SUBS[0][1])])
+
+def _escape_tex_match(match):
+    return LATEX_TABLE.get(match.group(0), r'\ldots')
 
 def escape_tex(value):
-    newval = value
-    for pattern, replacement in LATEX_SUBS:
-        newval = pattern.sub(replacement, newval)
-    return newval
+    if not isinstance(value, compat.string_types):
+        value = UNICODE_TYPE(value)
+    if not isinstance(value, UNICODE_TYPE) or u'\x00' in value:
+        # rare (byte strings only occur on Python 2), so use the slower
+        # version that neither decodes the value nor needs a placeholder
+        return RE_LATEX.sub(_escape_tex_match, value)
+    if type(value) is not UNICODE_TYPE:
+        # e.g. Markup, whose replace would escape the replacements
+        value = UNICODE_TYPE(value)
+    # str.replace is much faster than a regular expression, since most
+    # characters do not need escaping
+    for char, replacement in LATEX_REPLACEMENTS:
+        if char in value:
+            value = value.replace(char, replacement)
+    if u'...' in value:
+        value = RE_ELLIPSIS.sub(r'\\ldots', value)
+    return value
 
 
 #############################
 # Base64 encode images
 #############################
-try:
-    from PIL import Image
-except ImportError:
-    # if we don't have PIL available, include the image in its
-    # original size
-    def imgbase64(infile, max_size=None, dayone_folder=None):
+_NOT_LOADED = object()
+
+# PIL's Image module, or None if PIL is not available
+Image = _NOT_LOADED
+
+
+def _load_image_module():
+    """Import PIL, the first time it is needed"""
+    global Image, RESAMPLE
+    if Image is _NOT_LOADED:
+        try:
+            from PIL import Image
+        except ImportError:
+            # if we don't have PIL available, include the image in its
+            # original size
+            Image = None
+        else:
+            RESAMPLE = getattr(Image, 'LANCZOS',
+                               getattr(Image, 'ANTIALIAS', None))
+    return Image
+
+
+DEFAULT_MAX_SIZE = 400
+
+
+def image_format():
+    """The format in which imgbase64 encodes images"""
+    return 'jpeg' if _load_image_module() is not None else 'original'
+
+
+def _encode_image(path, max_size):
+    """Return the image at path as a base64 data URI"""
+    if _load_image_module() is None:
         warn_once('imgbase64')
-        filename, ext = os.path.splitext(infile)
-        with open(dayone_folder + "/" + infile, "rb") as image_file:
-            base64data = base64.b64encode(image_file.read())
+        filename, ext = os.path.splitext(path)
+        with open(path, "rb") as image_file:
+            base64data = base64.b64encode(image_file.read()).decode('ascii')
             return "data:image/%s;base64,%s" % (ext[1:], base64data)
-else:
+
     # if we have PIL, resize the image
-    def imgbase64(infile, max_size=400, dayone_folder=None):
-        size = max_size, max_size
-        filename, ext = os.path.splitext(infile)
-        im = Image.open(dayone_folder + "/" + infile)
-        im.thumbnail(size, Image.ANTIALIAS)
-        output = BytesIO()
-        im.save(output, "jpeg")  # we assume that we get best compressions with jpeg
-        base64data = output.getvalue().encode("base64")
-        return "data:image/jpeg;base64,%s" % (base64data)
+    size = max_size, max_size
+    im = Image.open(path)
+    im.thumbnail(size, RESAMPLE)
+    output = BytesIO()
+    im.save(output, "jpeg")  # we assume that we get best compressions with jpeg
+    base64data = base64.b64encode(output.getvalue()).decode('ascii')
+    return "data:image/jpeg;base64,%s" % (base64data)
+
+
+def encode_image_job(job):
+    """Encode a (path, max_size) pair for a pool of worker processes.
+
+    Returns None if the image cannot be read.
+    """
+    path, max_size = job
+    try:
+        return _encode_image(path, max_size)
+    except Exception:
+        return None
+
+
+def imgbase64(infile, max_size=DEFAULT_MAX_SIZE, dayone_folder=None,
+              cache=None):
+    """Return the photo as a base64 data URI.
+
+    If the Python Imaging Library is available, the photo is resized to fit
+    in a *max_size* square. If a :class:`dayone_export.cache.ThumbnailCache`
+    is given, previously encoded photos are reused.
+    """
+    path = dayone_folder + "/" + infile
+    if cache is None:
+        return _encode_image(path, max_size)
+
+    key = cache.key(path, max_size, image_format())
+    uri = cache.get(key)
+    if uri is None:
+        uri = _encode_image(path, max_size)
+        cache.put(key, uri)
+    return uri
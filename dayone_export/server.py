@@ -0,0 +1,157 @@
+# Copyright (c) 2012, Nathan Grigg
+# All rights reserved.
+# BSD License
+
+"""Export server, which keeps journals and templates in memory between exports.
+
+The server listens on a Unix socket and answers one request at a time.
+A request is a line of JSON of the form::
+
+    {"args": {parsed command line arguments}}
+
+and the answer is a line of JSON of the form::
+
+    {"error": message or null, "output": text, "stats": report or null}
+
+where ``output`` is what the export would have printed to stdout. Paths
+in the arguments are used as they are, so they should be absolute.
+"""
+
+from . import parse_journal
+from .cache import EntryCache
+from .stats import NO_STATS
+from . import watch
+import json
+import os
+import socket
+import stat
+import sys
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class JournalMemory(object):
+    """Parsed journals, kept until their entry or photo files change."""
+
+    def __init__(self):
+        self.journals = {}
+
+    def get(self, foldername, workers=None, cache_dir=None, rebuild=False,
+            stats=NO_STATS):
+        """Return the parsed journal, parsing it again if it has changed.
+
+        The arguments are as for :func:`dayone_export.parse_journal`, and
+        *cache_dir* and *rebuild* are used for its entry cache.
+        """
+        key = os.path.abspath(foldername)
+        # taken before parsing, so that changes made while parsing are
+        # noticed next time
+        files = watch.snapshot(foldername)
+        if not rebuild and key in self.journals:
+            old_files, journal = self.journals[key]
+            if old_files == files:
+                return journal
+        cache = None
+        if cache_dir is not None:
+            cache = EntryCache(foldername, cache_dir, rebuild=rebuild)
+        journal = parse_journal(foldername, workers=workers, cache=cache,
+                                stats=stats)
+        self.journals[key] = (files, journal)
+        return journal
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = self.server.answer(request['args'],
+                                          self.server.journals)
+        except Exception as err:
+            traceback.print_exc()
+            response = dict(error="{0}: {1}".format(type(err).__name__, err))
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ExportServer(socketserver.UnixStreamServer):
+    """Answer export requests sent to a Unix socket.
+
+    :param path: The path of the socket.
+    :param answer: Function called with the parsed command line arguments
+                   of each request, as a dictionary, and the server's
+                   :class:`JournalMemory`, which returns the response as
+                   a dictionary.
+    """
+
+    def __init__(self, path, answer):
+        self.answer = answer
+        self.journals = JournalMemory()
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # requests can write files anywhere the user can
+        os.chmod(self.server_address, 0o600)
+
+
+def _remove_stale(path):
+    """Remove the socket file of a server that is no longer running.
+
+    Returns an error message if path is something other than a socket.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        return "Not a socket: {0}".format(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.remove(path)
+    finally:
+        sock.close()
+
+
+def serve(path, answer):
+    """Answer requests on the socket at path until interrupted.
+
+    Returns an error message if the server cannot be started.
+    """
+    error = _remove_stale(path)
+    if error:
+        return error
+    server = ExportServer(path, answer)
+    sys.stderr.write("Listening on {0}\n".format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def request(path, args):
+    """Send an export request to the server at path and return its answer.
+
+    Raises :class:`socket.error` if the server cannot be reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        message = json.dumps(dict(args=args))
+        sock.sendall(message.encode('utf-8') + b'\n')
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        sock.close()
+    return json.loads(b''.join(data).decode('utf-8'))
@@ -0,0 +1,102 @@
+# Copyright (c) 2012, Nathan Grigg
+# All rights reserved.
+# BSD License
+
+"""Timing of the stages of an export."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Stats(object):
+    """Wall time, number of calls and bytes written for each stage.
+
+    Pass a Stats object to :func:`dayone_export.dayone_export` to find out
+    where an export spends its time. Stages can be nested: for example,
+    the time spent in the ``markdown`` filter is also part of ``render``.
+    Totals can be added from several threads.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, calls=1, bytes=0):
+        """Add to the totals of a stage."""
+        with self.lock:
+            totals = self.stages.setdefault(
+                    stage, {'seconds': 0.0, 'calls': 0, 'bytes': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+            totals['bytes'] += bytes
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager that adds its running time to a stage."""
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(stage, clock() - start)
+
+    def wrap(self, stage, func):
+        """Return a version of func whose calls are added to a stage."""
+        def timed(*args, **kwargs):
+            with self.timer(stage):
+                return func(*args, **kwargs)
+        return timed
+
+    def iterate(self, stage, iterable):
+        """Iterate, adding the time spent producing each item to a stage.
+
+        The stage is counted as one call, however many items there are.
+        """
+        iterator = iter(iterable)
+        self.add(stage, calls=1)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, clock() - start, calls=0)
+                return
+            self.add(stage, clock() - start, calls=0)
+            yield item
+
+    def as_dict(self):
+        """Return the totals of each stage, in the order they started."""
+        return OrderedDict((k, dict(v)) for k, v in self.stages.items())
+
+    def report(self):
+        """Return the totals as a table."""
+        lines = ['{0:<16} {1:>10} {2:>8} {3:>12}'.format(
+            'stage', 'seconds', 'calls', 'bytes')]
+        for stage, totals in self.stages.items():
+            lines.append('{0:<16} {1:>10.3f} {2:>8} {3:>12}'.format(
+                stage, totals['seconds'], totals['calls'],
+                totals['bytes'] or ''))
+        return '\n'.join(lines)
+
+
+class _NullStats(object):
+    """Same interface as Stats, but records nothing."""
+
+    def add(self, stage, seconds=0.0, calls=1, bytes=0):
+        pass
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def wrap(self, stage, func):
+        return func
+
+    def iterate(self, stage, iterable):
+        return iterable
+
+
+NO_STATS = _NullStats()
@@ -0,0 +1,129 @@
+# Copyright (c) 2012, Nathan Grigg
+# All rights reserved.
+# BSD License
+
+"""Wait for changes to the entries and photos of a journal.
+
+Uses inotify (through the optional ``inotify_simple`` package) if it is
+available, and otherwise checks the modification times of the files
+every few seconds.
+"""
+
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Seconds between checks of the files, when inotify is not available.
+POLL_INTERVAL = 2.0
+
+# Seconds to wait for more changes after the first one, since a sync
+# usually changes several files.
+SETTLE_TIME = 0.5
+
+
+def _watched(name, filename):
+    """Whether a file in the entries or photos folder is part of the journal"""
+    if filename.startswith('.'):
+        return False
+    return name != 'entries' or os.path.splitext(filename)[1] == '.doentry'
+
+
+def snapshot(foldername):
+    """Return the modification time and size of each file of the journal."""
+    files = {}
+    for name in ['entries', 'photos']:
+        folder = os.path.join(foldername, name)
+        try:
+            filenames = os.listdir(folder)
+        except OSError:
+            continue
+        for filename in filenames:
+            if not _watched(name, filename):
+                continue
+            path = os.path.join(folder, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat.st_mtime, stat.st_size)
+    return files
+
+
+class PollingWatcher(object):
+    """Find changes by comparing snapshots of the journal's files.
+
+    :param foldername: The Day One folder.
+    :param interval: Seconds between snapshots.
+    """
+
+    def __init__(self, foldername, interval=POLL_INTERVAL):
+        self.foldername = foldername
+        self.interval = interval
+        self.files = snapshot(foldername)
+
+    def wait(self):
+        """Wait until files are changed, and return their paths."""
+        while True:
+            time.sleep(self.interval)
+            files = snapshot(self.foldername)
+            changed = set(path for path in set(files) | set(self.files)
+                          if files.get(path) != self.files.get(path))
+            self.files = files
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Find changes using inotify.
+
+    :param foldername: The Day One folder.
+    """
+
+    FLAGS = ('CLOSE_WRITE', 'CREATE', 'DELETE', 'MODIFY', 'MOVED_FROM',
+             'MOVED_TO')
+
+    def __init__(self, foldername):
+        self.foldername = foldername
+        self.inotify = inotify_simple.INotify()
+        mask = 0
+        for flag in self.FLAGS:
+            mask |= getattr(inotify_simple.flags, flag)
+        self.folders = {}
+        for name in ['entries', 'photos']:
+            folder = os.path.join(foldername, name)
+            if os.path.isdir(folder):
+                self.folders[self.inotify.add_watch(folder, mask)] = name
+
+    def wait(self):
+        """Wait until files are changed, and return their paths."""
+        while True:
+            events = self.inotify.read(read_delay=int(SETTLE_TIME * 1000))
+            changed = set()
+            for event in events:
+                name = self.folders.get(event.wd)
+                if name is not None and _watched(name, event.name):
+                    changed.add(os.path.join(self.foldername, name,
+                                             event.name))
+            if changed:
+                return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def watcher(foldername):
+    """Return an InotifyWatcher if possible, or else a PollingWatcher."""
+    if inotify_simple is not None:
+        try:
+            return InotifyWatcher(foldername)
+        except (OSError, IOError):
+            # e.g. too many watches, or not Linux
+            pass
+    return PollingWatcher(foldername)
@@ -0,0 +1,133 @@
+# Copyright (c) 2012, Nathan Grigg
+# All rights reserved.
+# BSD License
+
+"""Writing of output files.
+
+Files are written to a temporary file and renamed into place, so that a
+partly written file never appears. When an export produces many files,
+they are written by background threads while the next file is rendered.
+"""
+
+from .stats import NO_STATS, clock
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Number of threads used by Writer.
+WRITER_THREADS = 4
+
+# Maximum number of rendered files waiting to be written.
+WRITER_QUEUE_SIZE = 16
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# read once, since it cannot be read without changing it, which is not
+# safe while other threads are creating files
+UMASK = _umask()
+
+
+def atomic_write(filename, chunks, stats=NO_STATS):
+    """Write the text chunks to filename, encoded as utf-8.
+
+    Returns the number of bytes written. If filename is a symbolic link,
+    the file it points to is replaced, and an existing file keeps its
+    permissions.
+    """
+    filename = os.path.realpath(filename)
+    folder = os.path.dirname(filename)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp',
+                               prefix='.' + os.path.basename(filename))
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            write = stats.wrap('write', f.write)
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                write(data)
+                size += len(data)
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp)
+        else:
+            # mkstemp only gives the owner permission to read the file
+            os.chmod(tmp, 0o666 & ~UMASK)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    stats.add('write', calls=0, bytes=size)
+    return size
+
+
+class Writer(object):
+    """Write files atomically in background threads.
+
+    :param threads: Number of threads writing files at the same time.
+    :param queue_size: Maximum number of files waiting to be written.
+                       When the queue is full, :meth:`write` waits.
+    :param stats: Where to add the time spent writing.
+    :type stats: :class:`dayone_export.stats.Stats`
+
+    If writing a file fails, no more files are written, and the error is
+    raised by the next call to :meth:`write` or :meth:`close`.
+    """
+
+    def __init__(self, threads=WRITER_THREADS, queue_size=WRITER_QUEUE_SIZE,
+                 stats=NO_STATS):
+        self.stats = stats
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.threads = [threading.Thread(target=self._work)
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is not None:
+                continue
+            filename, chunks = job
+            start = clock()
+            try:
+                size = atomic_write(filename, chunks)
+            except Exception as err:
+                if self.error is None:
+                    self.error = err
+                continue
+            self.stats.add('write', clock() - start, bytes=size)
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, filename, chunks):
+        """Render the chunks and queue them to be written to filename."""
+        self._raise()
+        self.queue.put((filename, list(chunks)))
+
+    def close(self):
+        """Wait until all the files are written."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise()
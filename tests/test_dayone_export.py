@@ -1,16 +1,31 @@
 import unittest
 import dayone_export as doe
 import dayone_export.cli
+import dayone_export.server
 from mock import patch
 import os
 import jinja2
+from collections import namedtuple
 from datetime import datetime
 import pytz
 import locale
+import pickle
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
 
 THIS_PATH = os.path.split(os.path.abspath(__file__))[0]
 FAKE_JOURNAL = os.path.join(THIS_PATH, 'fake_journal')
 REGRESSION_JOURNAL = os.path.join(THIS_PATH, 'regression')
+BENCHMARKS_PATH = os.path.join(os.path.dirname(THIS_PATH), 'benchmarks')
+
+sys.path.insert(0, BENCHMARKS_PATH)
+import escape_tex
+import startup
+import synthetic
 
 def reset_locale():
     locale.setlocale(locale.LC_ALL, "C")
@@ -58,6 +73,29 @@ class TestEntryObject(unittest.TestCase):
     def test_old_invalid_place_range_argument(self):
         self.assertRaises(TypeError, self.entry.place, 1, 3)
 
+    def test_nested_keys_are_not_copied(self):
+        self.assertFalse(hasattr(self.entry, '__dict__'))
+        self.assertNotIn('Country', self.entry._data)
+        self.assertEqual(self.entry['Country'], 'United States')
+        self.assertEqual(self.entry.data['Country'], 'United States')
+
+    def test_nested_key_priority(self):
+        entry = doe.Entry('', data={'Creation Date': datetime(2013, 1, 1),
+                                    'Name': 'top',
+                                    'Weather': {'Name': 'weather', 'A': 1},
+                                    'Location': {'A': 2}})
+        self.assertEqual(entry['Name'], 'top')
+        self.assertEqual(entry['A'], 2)
+        self.assertEqual(entry.data['A'], 2)
+        self.assertFalse('B' in entry)
+        self.assertRaises(KeyError, lambda: entry['B'])
+
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(self.entry, protocol))
+            self.assertEqual(copy.data, self.entry.data)
+            self.assertEqual(copy.filename, self.entry.filename)
+
     def test_place_list_argument(self):
         expected = 'Seattle, United States'
         actual = self.entry.place([1, 3])
@@ -105,6 +143,48 @@ class TestEntryObject(unittest.TestCase):
         for key in self.entry.keys():
             self.assertTrue(key in self.entry, key)
 
+class TestLazyEntry(unittest.TestCase):
+    def setUp(self):
+        self.filename = FAKE_JOURNAL + '/entries/full.doentry'
+
+    @patch('dayone_export._read_plist', side_effect=doe._read_plist)
+    def test_header_does_not_read_file(self, mock_read):
+        entry = doe.Entry(self.filename, lazy=True)
+        self.assertEqual(entry['Tags'], ['tag'])
+        self.assertEqual(entry['Creation Date'], datetime(2012, 1, 2))
+        self.assertEqual(entry['Starred'], False)
+        self.assertEqual(mock_read.call_count, 0)
+        self.assertEqual(entry['Country'], 'United States')
+        self.assertEqual(mock_read.call_count, 1)
+
+    def test_missing_header_field(self):
+        entry = doe.Entry(FAKE_JOURNAL + '/entries/00-first.doentry', lazy=True)
+        self.assertFalse('Tags' in entry)
+        self.assertRaises(KeyError, lambda: entry['Tags'])
+
+    def test_loaded_data_matches(self):
+        entry = doe.Entry(self.filename, lazy=True)
+        entry.set_photo('foo')
+        expected = doe.Entry(self.filename)
+        expected.set_photo('foo')
+        self.assertEqual(entry.data, expected.data)
+        self.assertEqual(sorted(entry.keys()), sorted(expected.keys()))
+
+    def test_lazy_journal_matches(self):
+        expected = doe.parse_journal(FAKE_JOURNAL)
+        actual = doe.parse_journal(FAKE_JOURNAL, lazy=True)
+        self.assertEqual([e.data for e in actual], [e.data for e in expected])
+
+    @patch('dayone_export._read_plist', side_effect=doe._read_plist)
+    def test_filtered_entries_are_not_read(self, mock_read):
+        list(doe.dayone_export(FAKE_JOURNAL, tags=['tag'], lazy=True))
+        self.assertEqual(mock_read.call_count, 1)
+
+    def test_bad_date(self):
+        with self.assertRaisesRegexp(doe.PlistError, "ISO 8601"):
+            doe.parse_journal(REGRESSION_JOURNAL, lazy=True)
+
+
 class TestJournalParser(unittest.TestCase):
     def setUp(self):
         self.j = doe.parse_journal(FAKE_JOURNAL)
@@ -120,6 +200,12 @@ class TestJournalParser(unittest.TestCase):
         result = j[0][k] <= j[1][k] <= j[2][k]
         self.assertTrue(result)
 
+    def test_parallel_parse_matches_serial(self):
+        parallel = doe.parse_journal(FAKE_JOURNAL, workers=2)
+        self.assertEqual([e['UUID'] for e in parallel],
+                         [e['UUID'] for e in self.j])
+        self.assertEqual([e.data for e in parallel], [e.data for e in self.j])
+
     @patch('jinja2.Template.render')
     def test_dayone_export_run(self, mock_render):
         list(doe.dayone_export(FAKE_JOURNAL))
@@ -153,6 +239,123 @@ class TestJournalParser(unittest.TestCase):
                 self.j, datetime(2013, 11, 14), datetime(2013, 11, 15))
         self.assertEqual(len(filtered), 1)
 
+    def test_date_span(self):
+        self.assertEqual(self.j.date_span(), (0, 4))
+        self.assertEqual(self.j.date_span(datetime(2013, 11, 14)), (2, 4))
+        self.assertEqual(self.j.date_span(None, datetime(2013, 11, 14)), (0, 2))
+        self.assertEqual(self.j.date_span(datetime(2013, 11, 15),
+                                          datetime(2013, 11, 14)), (3, 3))
+
+    def test_between_matches_scan(self):
+        dates = [None] + [e['Creation Date'] for e in self.j] + \
+                [datetime(2000, 1, 1), datetime(2100, 1, 1)]
+        for after in dates:
+            for before in dates:
+                expected = [e for e in self.j
+                            if (after is None or e['Creation Date'] >= after)
+                            and (before is None or e['Creation Date'] < before)]
+                self.assertEqual(list(self.j.between(after, before)), expected)
+                reverse = doe.Journal(reversed(self.j))
+                self.assertEqual(list(reverse.between(after, before)),
+                                 expected[::-1])
+
+    def test_positions_with_dates(self):
+        self.assertEqual(self.j.positions(tags='any',
+                                          after=datetime(2013, 11, 15)), [3])
+        self.assertEqual(self.j.positions(after=datetime(2013, 11, 14),
+                                          exclude=['absolutelyuniqtag22']), [2])
+
+    def test_unsorted_date_span(self):
+        reverse = doe.Journal(reversed(self.j))
+        self.assertRaises(ValueError, reverse.date_span)
+        self.assertEqual(reverse.positions(tags='any',
+                                           after=datetime(2013, 11, 15)), [0])
+
+    def test_changes_clear_indexes(self):
+        j = doe.parse_journal(FAKE_JOURNAL)
+        late = list(j.between(datetime(2013, 1, 1)))
+        last = late[-1]
+        self.assertIs(j.by_uuid(last['UUID']), last)
+        j.reverse()
+        self.assertEqual(list(j.between(datetime(2013, 1, 1))),
+                         late[::-1])
+        self.assertIs(j.by_uuid(last['UUID']), last)
+        del j[0]
+        self.assertEqual(list(j.between(datetime(2013, 1, 1))), late[:-1])
+        self.assertRaises(KeyError, j.by_uuid, last['UUID'])
+        j[0:0] = [last]
+        self.assertIs(j.by_uuid(last['UUID']), last)
+        tags = j.tag_counts()
+        j += [e for e in j if 'Tags' in e]
+        self.assertEqual(sum(j.tag_counts().values()),
+                         2 * sum(tags.values()))
+        j.sort(key=lambda e: e['Creation Date'])
+        self.assertEqual(j.date_span()[1], len(j))
+
+    def test_by_uuid(self):
+        entry = self.j[2]
+        self.assertIs(self.j.by_uuid(entry['UUID']), entry)
+        self.assertRaises(KeyError, self.j.by_uuid, 'porcupine')
+
+    def test_place_index(self):
+        self.assertEqual(self.j.place_index['United States'], [1, 2])
+        self.assertEqual(self.j.positions(place='Seattle'), [1])
+        self.assertEqual(self.j.positions(place='Seattle', tags='any'), [1])
+        self.assertEqual(self.j.positions(place='Santa Barbara',
+                                          tags='any'), [])
+        self.assertEqual(self.j.positions(place='Mars'), [])
+
+    def test_starred(self):
+        entries = [doe.Entry('', data={'Creation Date': datetime(2013, 1, i),
+                                       'Starred': i % 2 == 0})
+                   for i in range(1, 6)]
+        j = doe.Journal(entries)
+        self.assertEqual(j.starred(), [1, 3])
+        self.assertEqual(j.positions(starred=True), [1, 3])
+        self.assertEqual(j.positions(starred=False), [0, 2, 4])
+        self.assertEqual(j.positions(starred=True,
+                                     after=datetime(2013, 1, 3)), [3])
+
+    def test_query(self):
+        actual = self.j.query(after=datetime(2013, 11, 14),
+                              exclude=['absolutelyuniqtag22'],
+                              starred=False, place='United States')
+        self.assertIsInstance(actual, doe.Journal)
+        self.assertEqual(list(actual), [self.j[2]])
+        self.assertEqual(list(self.j.query()), list(self.j))
+
+    def test_tag_index(self):
+        self.assertEqual(self.j.tag_index['tag'], [1])
+        self.assertEqual(self.j.tag_counts(),
+                         {'tag': 1, 'absolutelyuniqtag22': 1})
+        self.assertEqual(self.j.tagged('any'), [1, 3])
+        self.assertEqual(self.j.tagged(['tag', 'absolutelyuniqtag22']), [1, 3])
+        self.assertEqual(self.j.tagged(['porcupine']), [])
+
+    def test_positions(self):
+        self.assertEqual(self.j.positions(), [0, 1, 2, 3])
+        self.assertEqual(self.j.positions(tags='any',
+                                          exclude=['absolutelyuniqtag22']), [1])
+
+    def test_index_filters_match_scan(self):
+        plain = list(self.j)
+        for tags in ['any', ['tag'], ['porcupine'], ['tag', 'absolutelyuniqtag22']]:
+            self.assertEqual(list(doe._filter_by_tag(self.j, tags)),
+                             list(doe._filter_by_tag(plain, tags)))
+            if tags != 'any':
+                self.assertEqual(list(doe._exclude_tags(self.j, tags)),
+                                 list(doe._exclude_tags(plain, tags)))
+
+    def test_select_entries_with_tags(self):
+        actual = doe._select_entries(self.j, tags='any',
+                                     exclude=['absolutelyuniqtag22'],
+                                     after=datetime(2012, 1, 1), reverse=True)
+        self.assertEqual([e['UUID'] for e in actual], [self.j[1]['UUID']])
+
+    def test_template_gets_journal(self):
+        groups = list(doe._group_entries(self.j, '%Y'))
+        self.assertTrue(all(isinstance(g, doe.Journal) for _, g in groups))
+
     def test_tags_any_tag(self):
         filtered = doe._filter_by_tag(self.j, 'any')
         self.assertEqual(len(list(filtered)), 2)
@@ -198,6 +401,687 @@ class TestJournalParser(unittest.TestCase):
         fnames = sorted(fn for fn, _ in gen)
         self.assertEqual(fnames, ["20111231", "20120101", "20131113", "20131207"])
 
+    def test_group_entries_adjacent(self):
+        groups = list(doe._group_entries(self.j, "%Y"))
+        self.assertEqual([k for k, _ in groups], ["2011", "2012", "2013"])
+        self.assertEqual([len(g) for _, g in groups], [1, 1, 2])
+
+    def test_group_entries_not_adjacent(self):
+        # 2011-12-31 and 2013-12-07 are both Saturdays
+        groups = list(doe._group_entries(self.j, "%a"))
+        self.assertEqual([k for k, _ in groups], ["Sat", "Sun", "Wed"])
+        self.assertEqual([len(g) for _, g in groups], [2, 1, 1])
+
+    def test_stream_matches_render(self):
+        expected = list(doe.dayone_export(FAKE_JOURNAL, filename_template="%Y"))
+        actual = [(k, ''.join(chunks)) for k, chunks in doe.dayone_export(
+            FAKE_JOURNAL, filename_template="%Y", stream=True)]
+        self.assertEqual(actual, expected)
+
+
+
+class TestEntryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp, 'journal')
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        shutil.copytree(FAKE_JOURNAL, self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def parse(self, rebuild=False):
+        cache = doe.cache.EntryCache(self.journal, self.cache_dir, rebuild)
+        return doe.parse_journal(self.journal, cache=cache)
+
+    def test_cached_journal_matches(self):
+        expected = doe.parse_journal(self.journal)
+        self.parse()
+        actual = self.parse()
+        self.assertEqual([e.data for e in actual], [e.data for e in expected])
+
+    @patch('dayone_export._read_plist', side_effect=doe._read_plist)
+    def test_only_changed_entries_are_read(self, mock_read):
+        self.parse()
+        self.assertEqual(mock_read.call_count, 4)
+        mock_read.reset_mock()
+        self.parse()
+        self.assertEqual(mock_read.call_count, 0)
+
+        filename = os.path.join(self.journal, 'entries', 'full.doentry')
+        with open(filename, 'a') as f:
+            f.write('\n')
+        self.parse()
+        mock_read.assert_called_once_with(filename)
+
+    @patch('dayone_export._read_plist', side_effect=doe._read_plist)
+    def test_rebuild(self, mock_read):
+        self.parse()
+        mock_read.reset_mock()
+        self.parse(rebuild=True)
+        self.assertEqual(mock_read.call_count, 4)
+
+    def test_removed_entries_are_dropped(self):
+        self.parse()
+        os.remove(os.path.join(self.journal, 'entries', 'full.doentry'))
+        self.assertEqual(len(self.parse()), 3)
+        cache = doe.cache.EntryCache(self.journal, self.cache_dir)
+        self.assertNotIn('full.doentry', cache.entries)
+
+
+class TestExportMany(unittest.TestCase):
+    def setUp(self):
+        self.outputs = [dict(format='html'),
+                        dict(format='md', filename_template='%Y'),
+                        dict(template='default.tex')]
+        self.expected = []
+        for output in self.outputs:
+            self.expected.extend(doe.dayone_export(FAKE_JOURNAL, **output))
+
+    def test_matches_separate_exports(self):
+        actual = list(doe.dayone_export_many(FAKE_JOURNAL, self.outputs))
+        self.assertEqual(actual, self.expected)
+
+    def test_parallel_matches_separate_exports(self):
+        actual = list(doe.dayone_export_many(FAKE_JOURNAL, self.outputs,
+                                             workers=2))
+        self.assertEqual(actual, self.expected)
+
+    def test_stream(self):
+        for workers in [None, 2]:
+            actual = [(k, ''.join(chunks)) for k, chunks in
+                      doe.dayone_export_many(FAKE_JOURNAL, self.outputs,
+                                             workers=workers, stream=True)]
+            self.assertEqual(actual, self.expected)
+
+    @patch('dayone_export.parse_journal', side_effect=doe.parse_journal)
+    def test_journal_is_parsed_once(self, mock_parse):
+        list(doe.dayone_export_many(FAKE_JOURNAL, self.outputs))
+        self.assertEqual(mock_parse.call_count, 1)
+
+
+class TestIncrementalExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp, 'journal')
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        self.output = os.path.join(self.tmp, '%Y.txt')
+        shutil.copytree(FAKE_JOURNAL, self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def export(self, **kwargs):
+        written = []
+        for filename, output in doe.dayone_export(
+                self.journal, format='txt', filename_template=self.output,
+                cache_dir=self.cache_dir, incremental=True, **kwargs):
+            with open(filename, 'w') as f:
+                f.write(output)
+            written.append(os.path.basename(filename))
+        return sorted(written)
+
+    def test_unchanged_groups_are_skipped(self):
+        self.assertEqual(self.export(), ['2011.txt', '2012.txt', '2013.txt'])
+        self.assertEqual(self.export(), [])
+
+    def test_changed_group_is_rendered(self):
+        self.export()
+        filename = os.path.join(self.journal, 'entries', 'zz-last.doentry')
+        with open(filename) as f:
+            contents = f.read()
+        with open(filename, 'w') as f:
+            f.write(contents.replace('Testing again.', 'Testing once more.'))
+        self.assertEqual(self.export(), ['2013.txt'])
+
+    def test_changed_photo_is_rendered(self):
+        self.export()
+        photo = os.path.join(self.journal, 'photos',
+                             '00F9FA96F29043D09638DF0866EC73B2.jpg')
+        with open(photo, 'ab') as f:
+            f.write(b'edited')
+        os.utime(photo, (0, 0))
+        self.assertEqual(len(self.export()), 1)
+
+    @patch('dayone_export._convert_markdown')
+    @patch('dayone_export._uses_filter', return_value=True)
+    def test_prepass_covers_changed_groups(self, mock_uses, mock_convert):
+        self.export()
+        filename = os.path.join(self.journal, 'entries', 'zz-last.doentry')
+        with open(filename) as f:
+            contents = f.read()
+        with open(filename, 'w') as f:
+            f.write(contents.replace('Testing again.', 'Testing once more.'))
+        self.assertEqual(self.export(workers=2), ['2013.txt'])
+        entries = mock_convert.call_args[0][0]
+        self.assertTrue(entries)
+        self.assertEqual(set(e['Date'].year for e in entries), set([2013]))
+
+    def test_missing_output_is_rendered(self):
+        self.export()
+        os.remove(os.path.join(self.tmp, '2012.txt'))
+        self.assertEqual(self.export(), ['2012.txt'])
+
+    def test_changed_options_render_everything(self):
+        self.export()
+        self.assertEqual(len(self.export(autobold=True)), 3)
+
+    def test_rebuild_renders_everything(self):
+        self.export()
+        self.assertEqual(len(self.export(rebuild_cache=True)), 3)
+
+    def test_requires_cache_dir(self):
+        gen = doe.dayone_export(self.journal, incremental=True)
+        self.assertRaises(ValueError, list, gen)
+
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.photo = 'photos/00F9FA96F29043D09638DF0866EC73B2.jpg'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_lru_eviction(self):
+        lru = doe.cache.LRUCache(max_bytes=6)
+        lru.put('a', 'aaa')
+        lru.put('b', 'bbb')
+        lru.get('a')
+        lru.put('c', 'ccc')
+        self.assertEqual(lru.get('a'), 'aaa')
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('c'), 'ccc')
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_imgbase64_uses_memory_cache(self, mock_encode):
+        cache = doe.cache.ThumbnailCache()
+        for _ in range(2):
+            actual = doe.filters.imgbase64(
+                    self.photo, dayone_folder=FAKE_JOURNAL, cache=cache)
+            self.assertEqual(actual, 'data:xyz')
+        self.assertEqual(mock_encode.call_count, 1)
+        doe.filters.imgbase64(
+                self.photo, 100, dayone_folder=FAKE_JOURNAL, cache=cache)
+        self.assertEqual(mock_encode.call_count, 2)
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_imgbase64_uses_disk_cache(self, mock_encode):
+        doe.filters.imgbase64(self.photo, dayone_folder=FAKE_JOURNAL,
+                              cache=doe.cache.ThumbnailCache(self.tmp))
+        actual = doe.filters.imgbase64(self.photo, dayone_folder=FAKE_JOURNAL,
+                                       cache=doe.cache.ThumbnailCache(self.tmp))
+        self.assertEqual(actual, 'data:xyz')
+        self.assertEqual(mock_encode.call_count, 1)
+
+    def test_disk_eviction(self):
+        cache = doe.cache.ThumbnailCache(self.tmp, max_bytes=10)
+        cache.put('a', 'aaaaaa')
+        os.utime(os.path.join(self.tmp, 'a.txt'), (0, 0))
+        cache.put('b', 'bbbbbb')
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['b.txt'])
+
+    @patch('dayone_export.filters.Image', None)
+    @patch('dayone_export.filters.warn_once')
+    def test_imgbase64_without_pil(self, mock_warn):
+        actual = doe.filters.imgbase64(self.photo, dayone_folder=FAKE_JOURNAL)
+        self.assertTrue(actual.startswith('data:image/jpg;base64,'), actual)
+
+
+class TestPhotoPrepass(unittest.TestCase):
+    def setUp(self):
+        self.env = jinja2.Environment(loader=jinja2.DictLoader({
+            'none.html': '{{ entry["Photo"] }}',
+            'default.html': '{{ entry["Photo"] | imgbase64 }}',
+            'sizes.html': '{{ p | imgbase64(100) }}{{ p | imgbase64(max_size=200) }}'
+                          '{{ p | imgbase64(size) }}',
+        }))
+        self.j = doe.parse_journal(FAKE_JOURNAL)
+
+    def test_no_imgbase64(self):
+        self.assertEqual(doe._imgbase64_sizes(self.env, 'none.html'), set())
+
+    def test_default_size(self):
+        self.assertEqual(doe._imgbase64_sizes(self.env, 'default.html'),
+                         set([doe.filters.DEFAULT_MAX_SIZE]))
+
+    def test_constant_sizes(self):
+        self.assertEqual(doe._imgbase64_sizes(self.env, 'sizes.html'),
+                         set([100, 200]))
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_encode_photos_fills_cache(self, mock_encode):
+        cache = doe.cache.ThumbnailCache()
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([100, 200]), cache, 1)
+        self.assertEqual(mock_encode.call_count, 2)
+        photo = self.j[0]['Photo']
+        doe.filters.imgbase64(photo, 100, dayone_folder=FAKE_JOURNAL, cache=cache)
+        doe.filters.imgbase64(photo, 200, dayone_folder=FAKE_JOURNAL, cache=cache)
+        self.assertEqual(mock_encode.call_count, 2)
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_encode_photos_stops_when_cache_is_full(self, mock_encode):
+        cache = doe.cache.ThumbnailCache(max_bytes=20)
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([100, 200, 300]), cache,
+                           1)
+        self.assertEqual(len(cache.memory.items), 2)
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_encode_photos_skips_cached(self, mock_encode):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([100]),
+                           doe.cache.ThumbnailCache(tmp), 1)
+        cache = doe.cache.ThumbnailCache(tmp)
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([100]), cache, 1)
+        self.assertEqual(mock_encode.call_count, 1)
+        # left on disk until the filter needs it
+        self.assertEqual(cache.memory.items, {})
+
+    @patch('dayone_export.filters._encode_image', side_effect=IOError)
+    def test_encode_photos_ignores_errors(self, mock_encode):
+        cache = doe.cache.ThumbnailCache()
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([100]), cache, 1)
+        self.assertEqual(cache.memory.items, {})
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_precomputed_leaves_photos_on_disk(self, mock_encode):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        thumbnails = doe.cache.ThumbnailCache(tmp)
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([400]), thumbnails, 1)
+        groups = [('all', None, self.j)]
+        with patch.object(thumbnails, 'get', side_effect=AssertionError):
+            _, uris = doe._precomputed(groups, False, set([400]),
+                                       FAKE_JOURNAL, False, False,
+                                       doe.cache.MarkdownCache(), thumbnails)
+        self.assertEqual(uris, {})
+
+    @patch('dayone_export.filters._encode_image', return_value='data:xyz')
+    def test_render_job_uses_precomputed(self, mock_encode):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.addCleanup(doe._worker_templates.clear)
+        doe.cache._markdown_memory.clear()
+        self.addCleanup(doe.cache._markdown_memory.clear)
+        template = os.path.join(tmp, 'photos.html')
+        with open(template, 'w') as f:
+            f.write('{% for entry in journal %}{{ entry.Text | markdown }}'
+                    '{% if entry.Photo %}{{ entry.Photo | imgbase64 }}'
+                    '{% endif %}{% endfor %}')
+        markdown_cache = doe.cache.MarkdownCache()
+        thumbnails = doe.cache.ThumbnailCache()
+        doe._encode_photos(self.j, FAKE_JOURNAL, set([400]), thumbnails, 1)
+        groups = [('all', None, self.j)]
+        html, uris = doe._precomputed(groups, True, set([400]), FAKE_JOURNAL,
+                                      False, False, markdown_cache,
+                                      thumbnails)
+        self.assertEqual(list(uris.values()), ['data:xyz'])
+        self.assertEqual(html, {})
+
+        html = dict((key, 'html') for key, _ in doe._markdown_keys(
+                self.j, False, False, markdown_cache))
+        options = dict(dayone_folder=FAKE_JOURNAL, template=template,
+                       template_dir=None, format=None, autobold=False,
+                       nl2br=False, thumbnail_dir=None,
+                       thumbnail_cache_size=2**20, cache_dir=None)
+        mock_encode.side_effect = AssertionError('encoded again')
+        with patch('markdown.Markdown.convert',
+                   side_effect=AssertionError('converted again')):
+            [(_, _, output)] = doe._render_job(
+                    (options, groups, datetime.today(), (html, uris)))
+        self.assertIn('data:xyz', output)
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'out.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def test_atomic_write(self):
+        size = doe.writer.atomic_write(self.path, [u'caf\xe9', u' ok'])
+        self.assertEqual(size, 8)
+        self.assertEqual(self.read(self.path), u'caf\xe9 ok')
+        self.assertEqual(os.listdir(self.tmp), ['out.html'])
+        mode = os.stat(self.path).st_mode & 0o777
+        self.assertEqual(mode, 0o666 & ~doe.writer.UMASK)
+
+    def test_atomic_write_keeps_mode(self):
+        doe.writer.atomic_write(self.path, [u'old'])
+        os.chmod(self.path, 0o640)
+        doe.writer.atomic_write(self.path, [u'new'])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), "requires symbolic links")
+    def test_atomic_write_follows_symlink(self):
+        os.mkdir(os.path.join(self.tmp, 'real'))
+        target = os.path.join(self.tmp, 'real', 'out.html')
+        doe.writer.atomic_write(target, [u'old'])
+        os.symlink(target, self.path)
+        doe.writer.atomic_write(self.path, [u'new'])
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(self.read(target), u'new')
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'real')),
+                         ['out.html'])
+
+    def test_failed_write_keeps_old_file(self):
+        doe.writer.atomic_write(self.path, [u'old'])
+        def chunks():
+            yield u'new'
+            raise IOError('render failed')
+        self.assertRaises(IOError, doe.writer.atomic_write, self.path,
+                          chunks())
+        self.assertEqual(self.read(self.path), u'old')
+        self.assertEqual(os.listdir(self.tmp), ['out.html'])
+
+    def test_writer(self):
+        stats = doe.Stats()
+        writer = doe.writer.Writer(threads=2, queue_size=1, stats=stats)
+        for i in range(10):
+            writer.write(os.path.join(self.tmp, str(i)), iter([u'x' * i]))
+        writer.close()
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         sorted(str(i) for i in range(10)))
+        self.assertEqual(self.read(os.path.join(self.tmp, '3')), 'xxx')
+        self.assertEqual(stats.as_dict()['write']['bytes'], 45)
+        self.assertEqual(stats.as_dict()['write']['calls'], 10)
+
+    def test_writer_error(self):
+        writer = doe.writer.Writer(threads=1)
+        writer.write(os.path.join(self.tmp, 'missing', 'a'), [u'a'])
+        self.assertRaises(OSError, writer.close)
+
+    def test_single_file_is_streamed(self):
+        single = os.path.join(self.tmp, 'journal.html')
+        split = os.path.join(self.tmp, '%Y.md')
+        write = doe.writer.Writer.write
+        with patch('dayone_export.writer.Writer.write', autospec=True,
+                   side_effect=write) as mock_write:
+            self.assertFalse(dayone_export.cli.run(
+                    ['--output', single, '--output', split, '--no-cache',
+                     FAKE_JOURNAL]))
+        written = [call[0][1] for call in mock_write.call_args_list]
+        self.assertEqual(len(written), 3)
+        self.assertNotIn(single, written)
+        self.assertTrue(os.path.exists(single))
+
+    @patch('sys.stdout')
+    def test_incremental_state_is_forgotten(self, mock_stdout):
+        output = os.path.join(self.tmp, '%Y.md')
+        args = ['--incremental', '--output', output, FAKE_JOURNAL]
+        with patch('dayone_export.cache.DEFAULT_CACHE_DIR', self.tmp):
+            with patch('dayone_export.writer.atomic_write',
+                       side_effect=IOError('disk full')):
+                self.assertRaises(IOError, dayone_export.cli.run, args)
+            path = doe.cache.OutputCache(output, self.tmp).path
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(dayone_export.cli.run(args))
+            self.assertTrue(os.path.exists(path))
+        for year in ['2011', '2012', '2013']:
+            self.assertTrue(os.path.exists(os.path.join(self.tmp, year + '.md')))
+
+class TestStartup(unittest.TestCase):
+    def test_cli_import_is_light(self):
+        self.assertEqual(startup.loaded_modules('import dayone_export.cli'),
+                         [])
+
+    def test_error_is_light(self):
+        code = ('import dayone_export.cli\n'
+                'dayone_export.cli.run(["--after", "x", "missing"])')
+        self.assertEqual(startup.loaded_modules(code), [])
+
+    def test_modules_load_when_needed(self):
+        code = ('import dayone_export.cli\n'
+                'dayone_export.cli.run(["--no-cache", "--format", "md", '
+                '"--after", "2012-01-01", {0!r}])'.format(FAKE_JOURNAL))
+        loaded = startup.loaded_modules(code, ['jinja2', 'pytz', 'dateutil'])
+        self.assertEqual(loaded, ['jinja2', 'pytz', 'dateutil'])
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "requires Unix sockets")
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp, 'journal.dayone')
+        shutil.copytree(FAKE_JOURNAL, self.journal)
+        self.socket = os.path.join(self.tmp, 'socket')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_journal_memory(self):
+        memory = doe.server.JournalMemory()
+        journal = memory.get(self.journal)
+        self.assertIs(memory.get(self.journal), journal)
+        self.assertIsNot(memory.get(self.journal, rebuild=True), journal)
+
+    def test_journal_memory_notices_changes(self):
+        memory = doe.server.JournalMemory()
+        journal = memory.get(self.journal)
+        os.remove(os.path.join(self.journal, 'entries', 'zz-last.doentry'))
+        changed = memory.get(self.journal)
+        self.assertEqual(len(changed), len(journal) - 1)
+
+    def test_answer(self):
+        memory = doe.server.JournalMemory()
+        args = dayone_export.cli.parse_args(
+                ['--format', 'md', '--no-cache', '--stats', self.journal])
+        response = dayone_export.cli.answer(vars(args), memory)
+        self.assertIsNone(response['error'])
+        self.assertIn('Basic example', response['output'])
+        self.assertTrue(response['stats'].startswith('stage'))
+        self.assertIn(os.path.abspath(self.journal), memory.journals)
+
+    def test_answer_error(self):
+        args = dayone_export.cli.parse_args([os.path.join(self.tmp,
+                                                          'missing')])
+        response = dayone_export.cli.answer(vars(args), None)
+        self.assertTrue(response['error'].startswith('File not found'))
+
+    def test_answer_watch(self):
+        args = dayone_export.cli.parse_args(
+                ['--watch', '--output', 'a.html', self.journal])
+        response = dayone_export.cli.answer(vars(args), None)
+        self.assertIn('--watch', response['error'])
+
+    @patch('dayone_export.compat.print_bytes')
+    def test_request(self, mock_print):
+        server = doe.server.ExportServer(self.socket, dayone_export.cli.answer)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        cwd = os.getcwd()
+        try:
+            # the journal is found relative to the client's directory
+            os.chdir(self.tmp)
+            code = dayone_export.cli.run(['--server', self.socket, '--format',
+                                          'md', '--no-cache', 'journal.dayone'])
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertFalse(code)
+        output = mock_print.call_args[0][0].decode('utf-8')
+        self.assertIn('Basic example', output)
+        self.assertEqual(os.stat(self.socket).st_mode & 0o777, 0o600)
+
+    def test_absolute_paths(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, cwd)
+        open('custom.md', 'w').close()
+        args = dayone_export.cli.absolute_paths(dayone_export.cli.parse_args(
+                ['--output', 'out/%Y.md', '--template', 'custom.md',
+                 '--template', 'default.html', '--template-dir', 'templates',
+                 'journal.dayone']))
+        tmp = os.getcwd()
+        self.assertEqual(args.journal, os.path.join(tmp, 'journal.dayone'))
+        self.assertEqual(args.output, [os.path.join(tmp, 'out', '%Y.md')])
+        self.assertEqual(args.template, [os.path.join(tmp, 'custom.md'),
+                                         'default.html'])
+        self.assertEqual(args.template_dir, os.path.join(tmp, 'templates'))
+
+    def test_request_writes_relative_output(self):
+        server = doe.server.ExportServer(self.socket, dayone_export.cli.answer)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.tmp)
+            with open('custom.md', 'w') as f:
+                f.write('{% for entry in journal %}{{ entry.Text }}'
+                        '{% endfor %}')
+            code = dayone_export.cli.run(['--server', self.socket,
+                                          '--template', 'custom.md',
+                                          '--output', 'out.md', '--no-cache',
+                                          'journal.dayone'])
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertFalse(code)
+        with open(os.path.join(self.tmp, 'out.md')) as f:
+            self.assertIn('Basic example', f.read())
+
+    def test_no_server(self):
+        actual = dayone_export.cli.run(['--server', self.socket, self.journal])
+        self.assertTrue(actual.startswith('Unable to connect'), actual)
+
+    def test_other_file_is_not_removed(self):
+        with open(self.socket, 'w') as f:
+            f.write('<html></html>')
+        actual = dayone_export.cli.run(['serve', self.socket])
+        self.assertTrue(actual.startswith('Not a socket'), actual)
+        self.assertTrue(os.path.exists(self.socket))
+
+    @patch('dayone_export.cli.serve')
+    @patch('dayone_export.cli.export', return_value=None)
+    def test_journal_named_serve(self, mock_export, mock_serve):
+        cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, cwd)
+        os.rename('journal.dayone', 'serve')
+        self.assertFalse(dayone_export.cli.run(['serve']))
+        self.assertFalse(mock_serve.called)
+        self.assertEqual(mock_export.call_args[0][0], 'serve')
+
+    def test_stale_socket_is_removed(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket)
+        sock.close()
+        doe.server._remove_stale(self.socket)
+        self.assertFalse(os.path.exists(self.socket))
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp, 'journal.dayone')
+        shutil.copytree(FAKE_JOURNAL, self.journal)
+        self.entry = os.path.join(self.journal, 'entries', 'full.doentry')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_snapshot(self):
+        open(os.path.join(self.journal, 'entries', '.sync'), 'w').close()
+        files = doe.watch.snapshot(self.journal)
+        self.assertEqual(len(files), 6)
+        self.assertIn(self.entry, files)
+
+    def test_polling(self):
+        watcher = doe.watch.PollingWatcher(self.journal, interval=0)
+        with open(self.entry, 'a') as f:
+            f.write('\n')
+        os.remove(os.path.join(self.journal, 'entries', '00-first.doentry'))
+        self.assertEqual(watcher.wait(), set([
+            self.entry,
+            os.path.join(self.journal, 'entries', '00-first.doentry')]))
+
+    @patch('dayone_export.watch.inotify_simple', None)
+    def test_fallback_to_polling(self):
+        watcher = doe.watch.watcher(self.journal)
+        self.assertIsInstance(watcher, doe.watch.PollingWatcher)
+
+    @patch('dayone_export.watch.inotify_simple')
+    def test_inotify(self, mock_inotify):
+        inotify = mock_inotify.INotify.return_value
+        inotify.add_watch.side_effect = [1, 2]
+        event = namedtuple('Event', 'wd name')
+        inotify.read.side_effect = [
+            [event(1, 'x.doentry~')],
+            [event(1, 'full.doentry'), event(2, 'a.jpg'), event(3, 'b')]]
+        watcher = doe.watch.watcher(self.journal)
+        self.assertIsInstance(watcher, doe.watch.InotifyWatcher)
+        self.assertEqual(watcher.wait(), set([
+            self.entry, os.path.join(self.journal, 'photos', 'a.jpg')]))
+
+class TestSyntheticJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmp, 'Journal.dayone')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_make_journal(self):
+        synthetic.make_journal(self.journal, entries=20)
+        j = doe.parse_journal(self.journal)
+        self.assertEqual(len(j), 20)
+        self.assertTrue(any('Tags' in e for e in j))
+        self.assertTrue(any('Location' in e for e in j))
+
+    def test_make_journal_is_deterministic(self):
+        synthetic.make_journal(self.journal, entries=5, seed=3)
+        other = os.path.join(self.tmp, 'Other.dayone')
+        synthetic.make_journal(other, entries=5, seed=3)
+        self.assertEqual([e.data for e in doe.parse_journal(self.journal)],
+                         [e.data for e in doe.parse_journal(other)])
+
+
+class TestStats(unittest.TestCase):
+    def test_timer_and_add(self):
+        stats = doe.Stats()
+        with stats.timer('a'):
+            pass
+        stats.add('a', 1.0, bytes=10)
+        self.assertEqual(stats.as_dict()['a']['calls'], 2)
+        self.assertEqual(stats.as_dict()['a']['bytes'], 10)
+        self.assertTrue(stats.as_dict()['a']['seconds'] >= 1.0)
+
+    def test_wrap(self):
+        stats = doe.Stats()
+        double = stats.wrap('double', lambda x: 2 * x)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(3), 6)
+        self.assertEqual(stats.as_dict()['double']['calls'], 2)
+
+    def test_iterate(self):
+        stats = doe.Stats()
+        self.assertEqual(list(stats.iterate('it', [1, 2])), [1, 2])
+        self.assertEqual(stats.as_dict()['it']['calls'], 1)
+
+    def test_export_stages(self):
+        stats = doe.Stats()
+        list(doe.dayone_export(FAKE_JOURNAL, tags='any', stats=stats))
+        stages = stats.as_dict()
+        for stage in ['parse', 'localize', 'filter', 'render', 'markdown',
+                      'format']:
+            self.assertIn(stage, stages)
+        self.assertEqual(stages['markdown']['calls'], 2)
+
+    def test_report(self):
+        stats = doe.Stats()
+        stats.add('write', 0.5, bytes=100)
+        lines = stats.report().split('\n')
+        self.assertEqual(lines[0].split(), ['stage', 'seconds', 'calls', 'bytes'])
+        self.assertEqual(lines[1].split(), ['write', '0.500', '1', '100'])
 
 
 class TestTemplateInheritance(unittest.TestCase):
@@ -260,13 +1144,84 @@ class TestTemplateInheritance(unittest.TestCase):
         expected = 'bar', 'foo'
         self.assertEqual(actual, expected)
 
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_template_is_compiled_once(self):
+        for cache_dir in [None, self.tmp]:
+            first = doe._load_template(FAKE_JOURNAL, cache_dir=cache_dir)
+            with patch.object(jinja2.Environment, 'compile',
+                              side_effect=AssertionError('compiled again')):
+                second = doe._load_template(FAKE_JOURNAL, nl2br=True,
+                                            cache_dir=cache_dir)
+            self.assertIsNot(first.environment, second.environment)
+
+    def test_filters_belong_to_each_export(self):
+        first = doe._load_template(FAKE_JOURNAL, cache_dir=self.tmp)
+        md = first.environment.filters['markdown']
+        second = doe._load_template(FAKE_JOURNAL, autobold=True,
+                                    cache_dir=self.tmp)
+        self.assertIsNot(second.environment.filters['markdown'], md)
+        self.assertIs(first.environment.filters['markdown'], md)
+
+    def test_interleaved_exports(self):
+        def export(**kwargs):
+            return doe.dayone_export(FAKE_JOURNAL, filename_template='%Y',
+                                     **kwargs)
+        expected = list(export(autobold=True))
+        self.assertNotEqual(expected, list(export()))
+        first = export(autobold=True)
+        actual = [next(first)]
+        list(export())
+        actual.extend(first)
+        self.assertEqual(actual, expected)
+
+    def test_tex_syntax_has_own_environment(self):
+        html = doe._load_template(FAKE_JOURNAL, format='html',
+                                  cache_dir=self.tmp)
+        tex = doe._load_template(FAKE_JOURNAL, format='tex',
+                                 cache_dir=self.tmp)
+        self.assertIsNot(html.environment, tex.environment)
+        self.assertEqual(tex.environment.variable_start_string, r'\VAR{')
+
+    def test_bytecode_cache(self):
+        doe._load_template(FAKE_JOURNAL, format='md', cache_dir=self.tmp)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp, 'templates'))),
+                         1)
+
+    def test_loader_key(self):
+        cwd = os.getcwd()
+        self.assertEqual(doe._loader_key('a/b.html', 'x'),
+                         ('path', os.path.join(cwd, 'a')))
+        self.assertEqual(doe._loader_key('b.html', 'x'),
+                         ('dir', os.path.join(cwd, 'x')))
+        self.assertEqual(doe._loader_key('b.html', None)[:2], ('default', cwd))
+        self.assertEqual(doe._loader_key(None, None)[:2], ('default', None))
+
 class TestCLI(unittest.TestCase):
     def setUp(self):
         self.silencer = patch('sys.stdout')
         self.silencer.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patcher = patch(
+                'dayone_export.cache.DEFAULT_CACHE_DIR', self.cache_dir)
+        self.cache_patcher.start()
 
     def tearDown(self):
         self.silencer.stop()
+        self.cache_patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    @patch('dayone_export.cli.dayone_export', return_value="")
+    def test_cache_dir(self, mock_doe):
+        dayone_export.cli.run([FAKE_JOURNAL])
+        self.assertEqual(mock_doe.call_args[1]['cache_dir'], self.cache_dir)
+        dayone_export.cli.run(['--no-cache', FAKE_JOURNAL])
+        self.assertEqual(mock_doe.call_args[1]['cache_dir'], None)
 
     @patch('dayone_export.cli.dayone_export', return_value="")
     def test_tag_splitter_protects_any(self, mock_doe):
@@ -275,6 +1230,83 @@ class TestCLI(unittest.TestCase):
         actual = mock_doe.call_args[1]['tags']
         self.assertEqual(expected, actual)
 
+    @patch('dayone_export.cli.dayone_export', return_value="")
+    def test_jobs(self, mock_doe):
+        dayone_export.cli.run(['--jobs', '4', FAKE_JOURNAL])
+        self.assertEqual(mock_doe.call_args[1]['workers'], 4)
+
+    def test_incremental_requires_output(self):
+        actual = dayone_export.cli.run(['--incremental', FAKE_JOURNAL])
+        self.assertTrue(actual.startswith('The --incremental option'), actual)
+
+    def test_watch_requires_output(self):
+        actual = dayone_export.cli.run(['--watch', FAKE_JOURNAL])
+        self.assertTrue(actual.startswith('The --watch option'), actual)
+
+    @patch('sys.stderr')
+    @patch('dayone_export.cli.export', return_value=None)
+    @patch('dayone_export.watch.watcher')
+    def test_watch(self, mock_watcher, mock_export, mock_stderr):
+        mock_watcher.return_value.wait.side_effect = [
+                set(['a.doentry']), set(['b.doentry']), KeyboardInterrupt]
+        dayone_export.cli.run(['--watch', '--rebuild-cache',
+                               '--output', 'out.html', FAKE_JOURNAL])
+        self.assertEqual(mock_export.call_count, 3)
+        options = mock_export.call_args[0][2]
+        self.assertTrue(options['incremental'])
+        self.assertFalse(options['rebuild_cache'])
+        mock_watcher.return_value.close.assert_called_once_with()
+
+    def test_multiple_outputs(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            html = os.path.join(tmp, 'journal.html')
+            md = os.path.join(tmp, 'journal-%Y.md')
+            code = dayone_export.cli.run(
+                    ['--output', html, '--output', md, FAKE_JOURNAL])
+            self.assertFalse(code)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                    ['journal-2011.md', 'journal-2012.md', 'journal-2013.md',
+                     'journal.html'])
+        finally:
+            shutil.rmtree(tmp)
+
+    @patch('dayone_export.cli.dayone_export_many', return_value="")
+    def test_output_template_pairs(self, mock_doe):
+        dayone_export.cli.run(['--output', 'a.html', '--template', 'x.html',
+                               '--output', 'b.tex', '--template', 'y.tex',
+                               FAKE_JOURNAL])
+        expected = [dict(filename_template='a.html', template='x.html',
+                         format='html'),
+                    dict(filename_template='b.tex', template='y.tex',
+                         format='tex')]
+        self.assertEqual(mock_doe.call_args[0][1], expected)
+
+    def test_templates_share_output(self):
+        actual = dayone_export.cli.run(
+                ['--output', 'out.txt', '--template', 'default.html',
+                 '--template', 'default.md', FAKE_JOURNAL])
+        self.assertEqual(actual, "Use a different --output for each --template")
+
+    @patch('dayone_export.cli.dayone_export_many', return_value="")
+    def test_templates_share_stdout(self, mock_doe):
+        self.assertFalse(dayone_export.cli.run(
+                ['--template', 'default.html', '--template', 'default.md',
+                 FAKE_JOURNAL]))
+
+    def test_output_template_mismatch(self):
+        actual = dayone_export.cli.run(
+                ['--output', 'a', '--output', 'b', '--output', 'c',
+                 '--template', 'x', '--template', 'y', FAKE_JOURNAL])
+        self.assertEqual(actual, "Use one --template for each --output")
+
+    @patch('sys.stderr')
+    def test_stats(self, mock_stderr):
+        dayone_export.cli.run(['--stats', FAKE_JOURNAL])
+        report = mock_stderr.write.call_args[0][0]
+        self.assertTrue(report.startswith('stage'), report)
+        self.assertIn('write', report)
+
     @patch('dayone_export.cli.dayone_export', return_value="")
     def test_tag_splitter(self, mock_doe):
         dayone_export.cli.run(['--tags', 'a, b', FAKE_JOURNAL])
@@ -287,7 +1319,7 @@ class TestCLI(unittest.TestCase):
         expected = 'Not a valid Day One package'
         self.assertTrue(actual.startswith(expected), actual)
 
-    @patch('dayone_export.jinja2.Template.render', side_effect=jinja2.TemplateNotFound('msg'))
+    @patch('jinja2.Template.generate', side_effect=jinja2.TemplateNotFound('msg'))
     def test_template_not_found(self, mock_doe):
         actual = dayone_export.cli.run([FAKE_JOURNAL])
         expected = "Template not found"
@@ -336,6 +1368,46 @@ class TestMarkdown(unittest.TestCase):
         text = "Footnote[^1]\n\n[^1]: Footnote text"
         self.assertNotEqual(self.md(text), self.md(text))
 
+    def test_markdown_instances_are_reused(self):
+        with patch('dayone_export.filters._local', threading.local()):
+            with patch('dayone_export.filters._markdown',
+                       side_effect=doe.filters._markdown) as mock_markdown:
+                for _ in range(3):
+                    doe.filters.markdown_filter()('text')
+                doe.filters.markdown_filter(nl2br=True)('text')
+        self.assertEqual(mock_markdown.call_count, 2)
+
+    def test_filters_in_threads(self):
+        texts = ['*{0}* and **{0}**\n\n- {0}\n- item'.format(i)
+                 for i in range(50)]
+        md = doe.filters.markdown_filter()
+        expected = [md(text) for text in texts]
+        errors = []
+
+        def convert():
+            md = doe.filters.markdown_filter()
+            try:
+                for _ in range(4):
+                    if [md(text) for text in texts] != expected:
+                        errors.append('wrong html')
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=convert) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_footnote_ids_belong_to_each_filter(self):
+        text = "Footnote[^1]\n\n[^1]: Footnote text"
+        first = doe.filters.markdown_filter()
+        expected = first(text)
+        second = doe.filters.markdown_filter()
+        self.assertNotEqual(first(text), expected)
+        self.assertEqual(second(text), expected)
+
     def test_hashtag_does_not_become_h1(self):
         expected = '<p>#tag and #tag</p>'
         actual = self.md('#tag and #tag')
@@ -361,6 +1433,148 @@ class TestMarkdown(unittest.TestCase):
         actual = self.nl2br('a\nb')
         self.assertEqual(expected, actual)
 
+class TestMarkdownCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'markdown.pickle')
+        doe.cache._markdown_memory.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_parallel_groups_match(self):
+        expected = list(doe.dayone_export(FAKE_JOURNAL,
+                                          filename_template='%Y-%m'))
+        actual = list(doe.dayone_export(FAKE_JOURNAL, workers=2,
+                                        filename_template='%Y-%m'))
+        self.assertEqual(len(actual), 4)
+        self.assertEqual(actual, expected)
+
+    def test_parallel_groups_stream(self):
+        expected = list(doe.dayone_export(FAKE_JOURNAL, reverse=True,
+                                          filename_template='%a'))
+        actual = [(k, ''.join(chunks)) for k, chunks in doe.dayone_export(
+                  FAKE_JOURNAL, workers=3, filename_template='%a',
+                  stream=True, reverse=True)]
+        self.assertEqual(actual, expected)
+
+    def test_pool_imap_keeps_order(self):
+        self.assertEqual(list(doe._pool_imap(abs, range(0, -20, -1), 3)),
+                         list(range(20)))
+
+    def test_batch_payloads_built_lazily(self):
+        self.addCleanup(doe._worker_templates.clear)
+        built = []
+        def imap(func, jobs, workers):
+            self.assertFalse(isinstance(jobs, list))
+            for job in jobs:
+                built.append(mock_precomputed.call_count)
+                yield func(job)
+        with patch('dayone_export._pool_imap', side_effect=imap), \
+             patch('dayone_export._precomputed',
+                   return_value=({}, {})) as mock_precomputed:
+            actual = list(doe.dayone_export(FAKE_JOURNAL, workers=2,
+                                            filename_template='%Y'))
+        self.assertEqual(len(actual), 3)
+        self.assertEqual(built, [1, 2, 3])
+
+    def test_markdown_job_matches_filter(self):
+        md = doe.filters.markdown_filter(autobold=True)
+        for text in ['This *is* a **test**.', 'Title\nline #tag', '']:
+            self.assertEqual(doe.filters.markdown_job((True, False, text)),
+                             md(text))
+
+    def test_convert_markdown_fills_cache(self):
+        j = doe.parse_journal(FAKE_JOURNAL)
+        cache = doe.cache.MarkdownCache()
+        doe._convert_markdown(j, False, True, cache, 1)
+        md = doe.filters.markdown_filter(nl2br=True, cache=cache)
+        with patch('markdown.Markdown.convert') as mock_convert:
+            for entry in j:
+                md(entry['Text'])
+        self.assertEqual(mock_convert.call_count, 0)
+
+    @patch('dayone_export.filters.markdown_job', return_value='html')
+    def test_convert_markdown_skips_footnotes(self, mock_job):
+        entries = [doe.Entry('', data={'Creation Date': datetime(2013, 1, 1),
+                                       'Entry Text': text})
+                   for text in ['a[^1]\n\n[^1]: b', 'c', 'c']]
+        doe._convert_markdown(entries, False, False,
+                              doe.cache.MarkdownCache(), 1)
+        mock_job.assert_called_once_with((False, False, 'c'))
+
+    def test_uses_filter(self):
+        env = jinja2.Environment(loader=jinja2.DictLoader({
+            'yes.html': '{{ text | markdown }}', 'no.html': '{{ text }}'}))
+        env.filters['markdown'] = lambda x: x
+        self.assertTrue(doe._uses_filter(env, 'yes.html', 'markdown'))
+        self.assertFalse(doe._uses_filter(env, 'no.html', 'markdown'))
+
+    def test_parallel_export_matches(self):
+        expected = list(doe.dayone_export(FAKE_JOURNAL))
+        doe.cache._markdown_memory.clear()
+        actual = list(doe.dayone_export(FAKE_JOURNAL, workers=2))
+        self.assertEqual(actual, expected)
+
+    def test_cached_output_matches(self):
+        md = doe.filters.markdown_filter(cache=doe.cache.MarkdownCache())
+        expected = '<p>This <em>is</em> a <strong>test</strong>.</p>'
+        self.assertEqual(expected, md('This *is* a **test**.'))
+        self.assertEqual(expected, md('This *is* a **test**.'))
+
+    @patch('markdown.Markdown.convert', return_value='html')
+    def test_memory_cache_is_shared(self, mock_convert):
+        doe.filters.markdown_filter(cache=doe.cache.MarkdownCache())('text')
+        doe.filters.markdown_filter(cache=doe.cache.MarkdownCache())('text')
+        self.assertEqual(mock_convert.call_count, 1)
+
+    @patch('markdown.Markdown.convert', return_value='html')
+    def test_options_are_part_of_key(self, mock_convert):
+        doe.filters.markdown_filter(cache=doe.cache.MarkdownCache())('text')
+        doe.filters.markdown_filter(
+                nl2br=True, cache=doe.cache.MarkdownCache())('text')
+        self.assertEqual(mock_convert.call_count, 2)
+
+    @patch('markdown.Markdown.convert', return_value='html')
+    def test_persistent_cache(self, mock_convert):
+        cache = doe.cache.MarkdownCache(self.path)
+        doe.filters.markdown_filter(cache=cache)('text')
+        cache.save()
+        doe.cache._markdown_memory.clear()
+        cache = doe.cache.MarkdownCache(self.path)
+        self.assertEqual(doe.filters.markdown_filter(cache=cache)('text'), 'html')
+        self.assertEqual(mock_convert.call_count, 1)
+
+    def test_partial_run_keeps_other_html(self):
+        cache = doe.cache.MarkdownCache(self.path)
+        cache.put('a', 'html a')
+        cache.put('b', 'html b')
+        cache.save()
+        cache = doe.cache.MarkdownCache(self.path)
+        cache.put('c', 'html c')
+        cache.save()
+        self.assertEqual(sorted(doe.cache.MarkdownCache(self.path).stored),
+                         ['a', 'b', 'c'])
+
+    def test_least_recently_used_is_discarded(self):
+        cache = doe.cache.MarkdownCache(self.path, max_bytes=12)
+        cache.put('a', 'html a')
+        cache.put('b', 'html b')
+        cache.save()
+        cache = doe.cache.MarkdownCache(self.path, max_bytes=12)
+        doe.cache._markdown_memory.clear()
+        self.assertEqual(cache.get('a'), 'html a')
+        cache.put('c', 'html c')
+        cache.save()
+        self.assertEqual(sorted(doe.cache.MarkdownCache(self.path).stored),
+                         ['a', 'c'])
+
+    def test_footnotes_are_not_cached(self):
+        md = doe.filters.markdown_filter(cache=doe.cache.MarkdownCache())
+        text = "Footnote[^1]\n\n[^1]: Footnote text"
+        self.assertNotEqual(md(text), md(text))
+
+
 class TestLatex(unittest.TestCase):
     def setUp(self):
         reset_locale()
@@ -380,6 +1594,40 @@ class TestLatex(unittest.TestCase):
         expected = r'\$\{\}\#\textasciicircum{}\&\textasciitilde{}'
         self.assertEqual(expected, actual)
 
+    def test_latex_escape_quotes_and_dots(self):
+        actual = doe.filters.escape_tex(r'"Well.. um... ok....", \~{}')
+        expected = (r"''Well.. um\ldots ok\ldots'', "
+                    r"\textbackslash{}\textasciitilde{}\{\}")
+        self.assertEqual(expected, actual)
+
+    def test_latex_escape_matches_regular_expressions(self):
+        corpus = [u'', u'plain text', u'\\\\', u'\\{}', u'{\\}', u'\\~\\^',
+                  u'\\textbackslashzzz', u'textbackslashzzz\\', u'a\x00\\b',
+                  u'\x00{...}', u'....\\...', u'caf\xe9 & "cr\xe8me"',
+                  u'C:\\Users\\me\\notes_{draft}.txt', escape_tex.SYMBOLS]
+        rng = random.Random(0)
+        alphabet = u'\\{}_#%&$~^". a\x00z\xe9'
+        for _ in range(500):
+            corpus.append(u''.join(rng.choice(alphabet)
+                                   for _ in range(rng.randint(1, 30))))
+        for text in corpus:
+            self.assertEqual(doe.filters.escape_tex(text),
+                             escape_tex.reference_escape_tex(text), repr(text))
+
+    @unittest.skipUnless(doe.compat.PY2, "byte strings are text on Python 2")
+    def test_latex_escape_byte_string(self):
+        text = u'caf\xe9 & co...'.encode('utf-8')
+        self.assertEqual(doe.filters.escape_tex(text),
+                         u'caf\xe9 \\& co\\ldots'.encode('utf-8'))
+
+    def test_latex_escape_markup(self):
+        actual = doe.filters.escape_tex(jinja2.Markup(u'a & b'))
+        self.assertEqual(actual, u'a \\& b')
+        self.assertIs(type(actual), type(u''))
+
+    def test_latex_escape_number(self):
+        self.assertEqual(doe.filters.escape_tex(42), u'42')
+
     def test_latex_sanity(self):
         _, actual = next(doe.dayone_export(FAKE_JOURNAL, format='tex'))
         expected = r'\documentclass'
@@ -409,13 +1657,93 @@ class TestDateFormat(unittest.TestCase):
         self.assertEqual(
             expected, doe.filters._strftime_portable(self.date, '%-m/%-d/%Y'))
 
+    def test_format_tz(self):
+        date = pytz.utc.localize(datetime(2014, 2, 3, 6))
+        self.assertEqual(doe.filters.format(date, '%-d %H', tz='US/Pacific'),
+                         '2 22')
+        self.assertRaises(pytz.UnknownTimeZoneError, doe.filters.format,
+                          date, tz='Porcupine/Nowhere')
+
+    def test_format_date(self):
+        self.assertEqual(doe.filters.format(self.date.date()),
+                         'Monday, Feb 3, 2014')
+
+    @patch('dayone_export.filters._native_minus', False)
+    @patch('dayone_export.filters._formatters', {})
+    def test_compiled_portable_format(self):
+        formatter = doe.filters.compile_format('%-m/%-d/%Y')
+        self.assertIs(doe.filters.compile_format('%-m/%-d/%Y'), formatter)
+        self.assertEqual(formatter(self.date), '2/3/2014')
+
+    def test_formatted_dates_are_remembered(self):
+        doe.filters._formatted.clear()
+        with patch('dayone_export.filters.compile_format',
+                   side_effect=doe.filters.compile_format) as mock_compile:
+            for _ in range(3):
+                doe.filters.format(self.date, '%Y')
+        self.assertEqual(mock_compile.call_count, 1)
+
+    def test_same_instant_in_other_zone(self):
+        date = pytz.utc.localize(datetime(2014, 2, 3, 6))
+        other = date.astimezone(pytz.timezone('US/Pacific'))
+        self.assertEqual(doe.filters.format(date, '%H'), '06')
+        self.assertEqual(doe.filters.format(other, '%H'), '22')
+
+class TestTimeZones(unittest.TestCase):
+    @patch('pytz.timezone', side_effect=pytz.timezone)
+    def test_timezone_is_remembered(self, mock_timezone):
+        doe.filters._timezones.clear()
+        for _ in range(3):
+            self.assertEqual(doe.filters.timezone('Asia/Tokyo').zone,
+                             'Asia/Tokyo')
+            self.assertIs(doe.filters.timezone('Porcupine/Nowhere'), pytz.utc)
+        self.assertEqual(mock_timezone.call_count, 2)
+        self.assertRaises(pytz.UnknownTimeZoneError, doe.filters.timezone,
+                          'Porcupine/Nowhere', default=None)
+
+    def test_localized_date_matches_astimezone(self):
+        tz = pytz.timezone('America/New_York')
+        for month in range(1, 13):
+            date = datetime(2013, month, 10, 4, 30)
+            entry = doe.Entry('', data={'Creation Date': date})
+            entry.set_localized_date('America/New_York')
+            expected = pytz.utc.localize(date).astimezone(tz)
+            self.assertEqual(entry['Date'], expected)
+            self.assertEqual(entry['Date'].utcoffset(), expected.utcoffset())
+
+    def test_unknown_time_zone(self):
+        entry = doe.Entry('', data={'Creation Date': datetime(2013, 1, 1)})
+        entry.set_localized_date('Porcupine/Nowhere')
+        self.assertEqual(entry['Date'], pytz.utc.localize(datetime(2013, 1, 1)))
+
+    def test_localize_groups_by_zone(self):
+        dates = [datetime(2013, 1, i) for i in range(1, 5)]
+        zones = ['Asia/Tokyo', None, 'UTC', None]
+        entries = []
+        for date, zone in zip(dates, zones):
+            data = {'Creation Date': date}
+            if zone:
+                data['Time Zone'] = zone
+            entries.append(doe.Entry('', data=data))
+        doe._localize(entries)
+        self.assertEqual([e['Time Zone'] for e in entries],
+                         ['Asia/Tokyo', 'UTC', 'UTC', 'UTC'])
+        self.assertEqual(entries[0]['Date'].tzinfo.zone, 'Asia/Tokyo')
+        self.assertEqual(entries[3]['Date'].utcoffset().total_seconds(), 0)
+
 class TestDefaultTemplates(unittest.TestCase):
     def setUp(self):
         self.silencer = patch('sys.stdout')
         self.silencer.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patcher = patch(
+                'dayone_export.cache.DEFAULT_CACHE_DIR', self.cache_dir)
+        self.cache_patcher.start()
 
     def tearDown(self):
         self.silencer.stop()
+        self.cache_patcher.stop()
+        shutil.rmtree(self.cache_dir)
 
     @SkipIfMissingLocale(LOCALE["en"])
     def test_default_html_template_english(self):
@@ -438,3 +1766,7 @@ class TestRegression(unittest.TestCase):
     def test_regression(self):
         with self.assertRaisesRegexp(doe.PlistError, "ISO 8601"):
             doe.Entry(os.path.join(REGRESSION_JOURNAL, "entries/bad-date.doentry"))
+
+    def test_regression_parallel(self):
+        with self.assertRaisesRegexp(doe.PlistError, "ISO 8601"):
+            doe.parse_journal(REGRESSION_JOURNAL, workers=2)